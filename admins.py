@@ -0,0 +1,55 @@
+import logging
+from typing import FrozenSet
+
+# noinspection PyPackageRequirements
+from telegram import Bot, ChatMember
+
+from mwt import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.CREATOR)
+
+
+class AdminCache:
+    """Ids of the administrators of each chat. A chat's list is fetched with get_chat_administrators() the first time
+    it's needed, then it's kept up to date by the chat_member updates. Telegram sends those updates only to bots that
+    are administrators: in the other chats the list is re-fetched after fallback_timeout seconds"""
+
+    def __init__(self, fallback_timeout: float = 60 * 60, pushed_timeout: float = 60 * 60 * 24, maxsize: int = 4096):
+        self.fallback_timeout = fallback_timeout
+        self.pushed_timeout = pushed_timeout
+
+        self._bot_id = None
+        self.cache = TTLCache(fallback_timeout, maxsize)
+        self.fetches = 0
+        self.pushes = 0
+
+    def _timeout(self, admin_ids: FrozenSet[int]) -> float:
+        # if we are an administrator, we will receive the chat_member updates
+        return self.pushed_timeout if self._bot_id in admin_ids else self.fallback_timeout
+
+    def get(self, bot: Bot, chat_id: int) -> FrozenSet[int]:
+        def fetch():
+            self.fetches += 1
+            logger.debug("fetching the administrators of %d", chat_id)
+            return frozenset(admin.user.id for admin in bot.get_chat_administrators(chat_id))
+
+        self._bot_id = bot.id
+        return self.cache.get_or_load(chat_id, fetch, timeout_func=self._timeout)
+
+    def on_member_status(self, chat_id: int, user_id: int, status: str):
+        """To be called with every chat_member/my_chat_member update. If the user is our bot, the chat's list is
+        dropped: whether we will receive the chat_member updates might have changed"""
+
+        if user_id == self._bot_id:
+            self.cache.pop(chat_id)
+            return
+
+        is_admin = status in ADMIN_STATUSES
+        if self.cache.update(chat_id, lambda admin_ids: (admin_ids | {user_id}) if is_admin else (admin_ids - {user_id})):
+            self.pushes += 1
+            logger.debug("administrators of %d updated: %d is admin: %s", chat_id, user_id, is_admin)
+
+    def stats(self) -> dict:
+        return dict(fetches=self.fetches, pushes=self.pushes, **self.cache.stats())
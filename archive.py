@@ -0,0 +1,80 @@
+import datetime
+import logging
+import pickle
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+from santa import SecretSanta
+from storage import dumps
+
+logger = logging.getLogger(__name__)
+
+
+class SantaArchive:
+    """Started Secret Santas, kept out of bot_data so they're not pickled again on every flush. They're stored in a
+    SQLite table indexed by chat and by start time: rows are only appended, read back by chat (to avoid repeating
+    the previous pairs) and deleted by start time range, once they're older than the retention period"""
+
+    def __init__(self, file_path: str = 'persistence/archive.sqlite'):
+        self.file_path = file_path
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS started_santas ("
+            "chat_id INTEGER NOT NULL, "
+            "santa_message_id INTEGER NOT NULL, "
+            "started_on REAL NOT NULL, "
+            "santa BLOB NOT NULL, "
+            "PRIMARY KEY (chat_id, santa_message_id))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS started_santas_started_on ON started_santas (started_on)")
+
+    @staticmethod
+    def _row(santa: SecretSanta) -> tuple:
+        started_on = santa.started_on or santa.created_on  # santas started by old versions might not have it
+        return santa.chat_id, santa.santa_message_id, started_on.timestamp(), dumps(santa)
+
+    def add(self, santa: SecretSanta):
+        self.add_many([santa])
+
+    def add_many(self, santas: Iterable[SecretSanta]) -> int:
+        rows = [self._row(santa) for santa in santas]
+        with self._lock:
+            # a santa archived twice (eg. the bot stopped right after archiving it) replaces itself
+            self._connection.executemany("INSERT OR REPLACE INTO started_santas VALUES (?, ?, ?, ?)", rows)
+
+        return len(rows)
+
+    def chat_santas(self, chat_id: int, since: Optional[datetime.datetime] = None) -> List[SecretSanta]:
+        """The santas started in a chat, optionally only the ones started after `since`"""
+
+        since_timestamp = since.timestamp() if since else 0
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT santa FROM started_santas WHERE chat_id = ? AND started_on >= ? ORDER BY started_on",
+                (chat_id, since_timestamp)
+            ).fetchall()
+
+        return [pickle.loads(blob) for blob, in rows]
+
+    def delete_started_before(self, before: datetime.datetime) -> int:
+        with self._lock:
+            cursor = self._connection.execute("DELETE FROM started_santas WHERE started_on < ?", (before.timestamp(),))
+
+        logger.info("deleted %d archived santas started before %s", cursor.rowcount, before)
+        return cursor.rowcount
+
+    def count_started_since(self, since: datetime.datetime) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM started_santas WHERE started_on >= ?", (since.timestamp(),)
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.close()
@@ -0,0 +1,203 @@
+"""A local HTTP server implementing the subset of the Bot API the bot uses, answered by benchmarks.fakebot. Updates
+are queued with push() and handed to the bot by getUpdates (long polling). Every other call can be slowed down by a
+configurable latency and fail with 429 (RetryAfter) with a configurable probability.
+The time of every message sent and callback query answered is recorded, to measure how long the bot took to react"""
+
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+# noinspection PyPackageRequirements
+from telegram.error import TelegramError, Unauthorized
+
+import ratelimit
+from benchmarks.fakebot import FakeRequest
+
+logger = logging.getLogger(__name__)
+
+MAX_POLL_WAIT = 1.  # seconds: getUpdates returns earlier than the bot's timeout, so that stopping the bot is quick
+
+
+class BotAPIServer:
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            latency: float = 0.,
+            jitter: float = 0.,
+            rate_limit: float = 0.,
+            retry_after: int = 1,
+            blocked_by: Iterable[int] = (),
+            seed: Optional[int] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit  # probability that a call that sends something fails with 429
+        self.retry_after = retry_after
+
+        self.api = FakeRequest(blocked_by=blocked_by)
+
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.errors = Counter()
+        self.sent: Dict[int, List[float]] = defaultdict(list)  # chat_id -> times of the messages sent to the chat
+        self.answered: Dict[str, float] = {}  # callback query id -> time it was answered
+        self.last_call = time.monotonic()  # of the last call other than getUpdates
+
+        self._updates: List[dict] = []
+        self._fetched_update_id = 0  # the highest update_id returned by getUpdates
+        self._last_update_id = 0
+        self._updates_condition = threading.Condition()
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """To be used as the bot's base_url"""
+
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="botapi_server", daemon=True)
+        self._thread.start()
+        logger.info("Bot API stand-in listening on %s", self.url)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push(self, update: dict):
+        with self._updates_condition:
+            self._updates.append(update)
+            self._last_update_id = update["update_id"]
+            self._updates_condition.notify_all()
+
+    def all_fetched(self) -> bool:
+        with self._updates_condition:
+            return self._fetched_update_id >= self._last_update_id
+
+    def _get_updates(self, data: dict) -> List[dict]:
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or 100)
+        timeout = min(float(data.get("timeout") or 0), MAX_POLL_WAIT)
+
+        deadline = time.monotonic() + timeout
+        with self._updates_condition:
+            # updates before the offset have been confirmed by the bot
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.pop(0)
+
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_condition.wait(deadline - time.monotonic())
+
+            updates = self._updates[:limit]
+            if updates:
+                self._fetched_update_id = max(self._fetched_update_id, updates[-1]["update_id"])
+
+            return updates
+
+    def _is_rate_limited(self, method: str) -> bool:
+        if not self.rate_limit or not ratelimit.OutboundScheduler.is_paced(method):
+            return False
+
+        with self._lock:
+            return self._rng.random() < self.rate_limit
+
+    def _delay(self) -> float:
+        if not self.jitter:
+            return self.latency
+
+        with self._lock:
+            return self.latency + self._rng.uniform(0, self.jitter)
+
+    def call(self, method: str, data: dict) -> (int, dict):
+        """(HTTP status, response body) of a Bot API call"""
+
+        with self._lock:
+            self.calls[method] += 1
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(data)}
+
+        with self._lock:
+            self.last_call = time.monotonic()
+
+        delay = self._delay()
+        if delay:
+            time.sleep(delay)
+
+        if self._is_rate_limited(method):
+            with self._lock:
+                self.rate_limited[method] += 1
+
+            description = f"Too Many Requests: retry after {self.retry_after}"
+            return 429, {"ok": False, "error_code": 429, "description": description, "parameters": {"retry_after": self.retry_after}}
+
+        try:
+            result = self.api.post(method, data)
+        except TelegramError as e:
+            with self._lock:
+                self.errors[method] += 1
+
+            status = 403 if isinstance(e, Unauthorized) else 400
+            return status, {"ok": False, "error_code": status, "description": e.message}
+
+        now = time.monotonic()
+        with self._lock:
+            if method == "sendMessage":
+                self.sent[int(data["chat_id"])].append(now)
+            elif method == "answerCallbackQuery":
+                self.answered[str(data["callback_query_id"])] = now
+
+        return 200, {"ok": True, "result": result}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like api.telegram.org: the bot's connection pool is reused
+
+            def _data(self) -> dict:
+                data = dict(parse_qsl(urlsplit(self.path).query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if not length:
+                    return data
+
+                body = self.rfile.read(length)
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    data.update(json.loads(body))
+                else:
+                    data.update(parse_qsl(body.decode("utf-8")))
+
+                return data
+
+            def _respond(self):
+                # /bot<token>/<method>
+                method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+                status, body = server.call(method, self._data())
+
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+        return Handler
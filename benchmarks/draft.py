@@ -0,0 +1,73 @@
+"""Benchmark drafting.draft() with no, sparse and dense exclusions: time per draft, and how often the uniform
+rejection sampling was accepted instead of falling back to bipartite matching.
+
+Run from the repository root: python -m benchmarks.draft [PARTICIPANTS_COUNT ...]
+"""
+
+import logging
+import random
+import sys
+import time
+
+import drafting
+
+DEFAULT_SIZES = (10, 100, 1_000, 10_000)
+DRAFTS = 5
+DENSE_MAX_EXCLUSIONS = 250  # per participant: a quarter of the participants, up to this
+
+
+def no_exclusions(participants: list, rng: random.Random) -> drafting.Exclusions:
+    return {}
+
+
+def sparse_exclusions(participants: list, rng: random.Random) -> drafting.Exclusions:
+    """Couples (excluded both ways) plus one previous receiver each"""
+
+    shuffled = participants[:]
+    rng.shuffle(shuffled)
+    couples = zip(shuffled[0::2], shuffled[1::2])
+    exclusions = drafting.exclusions_from_pairs(couples, symmetric=True)
+    previous = drafting.exclusions_from_pairs(zip(participants, shuffled))
+    return drafting.merge_exclusions(exclusions, previous)
+
+
+def dense_exclusions(participants: list, rng: random.Random) -> drafting.Exclusions:
+    count = min(len(participants) // 4, DENSE_MAX_EXCLUSIONS)
+    return {santa: set(rng.sample(participants, count)) for santa in participants}
+
+
+def run(participants_count: int, exclusions_factory, rng: random.Random):
+    participants = list(range(participants_count))
+    exclusions = exclusions_factory(participants, rng)
+
+    sampled = 0
+    start = time.perf_counter()
+    for _ in range(DRAFTS):
+        pairs = drafting.draft(participants, exclusions, rng=rng)
+        assert all(drafting.is_valid(santa, receiver, exclusions) for santa, receiver in pairs)
+        assert len({receiver for _, receiver in pairs}) == participants_count
+
+    seconds = (time.perf_counter() - start) / DRAFTS
+
+    # how many single attempts are accepted, out of 100
+    for _ in range(100):
+        if drafting.sample(participants, exclusions, rng):
+            sampled += 1
+
+    return seconds, sampled
+
+
+def main(sizes):
+    rng = random.Random(1)
+    factories = (("none", no_exclusions), ("sparse", sparse_exclusions), ("dense", dense_exclusions))
+
+    print(f"{'exclusions':<10} {'participants':>12} {'per draft':>12} {'accepted samples':>18}")
+    for participants_count in sizes:
+        for name, factory in factories:
+            seconds, sampled = run(participants_count, factory, rng)
+            print(f"{name:<10} {participants_count:>12} {seconds * 1000:>10.2f}ms {sampled:>17}%")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
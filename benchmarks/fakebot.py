@@ -0,0 +1,151 @@
+"""An in-process stand-in for the Bot API, so that handlers can be run (and measured) offline, plus helpers to build
+the updates Telegram would send."""
+
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from typing import Iterable, Optional
+
+# noinspection PyPackageRequirements
+from telegram import Update, Bot, ParseMode
+# noinspection PyPackageRequirements
+from telegram.error import Unauthorized
+# noinspection PyPackageRequirements
+from telegram.ext import ExtBot, Defaults
+# noinspection PyPackageRequirements
+from telegram.utils.request import Request
+
+BOT_ID = 123456789
+BOT_USERNAME = "fake_santa_bot"
+TOKEN = f"{BOT_ID}:fake-token"
+
+
+def user_dict(user_id: int, first_name: Optional[str] = None, is_bot: bool = False) -> dict:
+    return {"id": user_id, "is_bot": is_bot, "first_name": first_name or f"user {user_id}"}
+
+
+def chat_dict(chat_id: int, title: str = "group") -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"user {chat_id}"}
+
+    return {"id": chat_id, "type": "supergroup", "title": title}
+
+
+class FakeRequest(Request):
+    """Answers the Bot API calls in memory, the way Telegram would for a bot that can do everything. Calls are
+    counted per method. `delay` seconds are slept on every call, to simulate the network; messages to the users in
+    `blocked_by` fail as if they had blocked the bot"""
+
+    __slots__ = ("delay", "blocked_by", "calls", "_message_ids", "_lock")
+
+    def __init__(self, delay: float = 0., blocked_by: Iterable[int] = ()):
+        super().__init__(con_pool_size=1)
+        self.delay = delay
+        self.blocked_by = set(blocked_by)
+        self.calls = Counter()
+
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _message(self, data: dict) -> dict:
+        chat_id = int(data["chat_id"])
+        message_id = data.get("message_id") or next(self._message_ids)
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": chat_dict(chat_id),
+            "from": user_dict(BOT_ID, "Secret Santa", is_bot=True),
+            "text": data.get("text", ""),
+        }
+        reply_markup = data.get("reply_markup")
+        if reply_markup:
+            # serialized by the bot before being posted
+            message["reply_markup"] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+
+        return message
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        method = url.rsplit("/", 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        if method == "getMe":
+            return dict(user_dict(BOT_ID, "Secret Santa", is_bot=True), username=BOT_USERNAME)
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            if int(data["chat_id"]) in self.blocked_by:
+                raise Unauthorized("Forbidden: bot was blocked by the user")
+
+            return self._message(data)
+        elif method == "sendChatAction" and int(data["chat_id"]) in self.blocked_by:
+            raise Unauthorized("Forbidden: bot was blocked by the user")
+        elif method == "getChatAdministrators":
+            return [{"status": "creator", "user": user_dict(1), "is_anonymous": False}]
+
+        return True
+
+
+def fake_bot(request: Optional[FakeRequest] = None, bot_class=ExtBot, **kwargs) -> Bot:
+    return bot_class(TOKEN, request=request or FakeRequest(), **kwargs)
+
+
+def fake_ext_bot(request: Optional[FakeRequest] = None) -> ExtBot:
+    """A bot with the same defaults main.py uses"""
+
+    return fake_bot(request, defaults=Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True))
+
+
+class Updates:
+    """Builds the updates a group and its members would generate, as Update objects or, without a bot, as the dicts
+    getUpdates would return"""
+
+    def __init__(self, bot: Optional[Bot] = None):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+        self._callback_ids = itertools.count(1)
+
+    def _update(self, update_dict: dict) -> Update:
+        return Update.de_json(update_dict, self.bot)
+
+    def message_dict(self, chat_id: int, user_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": chat_dict(chat_id),
+            "from": user_dict(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command_length = len(text.split(" ", 1)[0])
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback_query_dict(self, chat_id: int, user_id: int, data: str, message_id: Optional[int] = None) -> dict:
+        message = {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": chat_dict(chat_id),
+            "from": user_dict(BOT_ID, "Secret Santa", is_bot=True),
+            "text": "",
+        }
+        callback_query = {
+            "id": str(next(self._callback_ids)),
+            "from": user_dict(user_id),
+            "chat_instance": str(chat_id),
+            "message": message,
+            "data": data,
+        }
+
+        return {"update_id": next(self._update_ids), "callback_query": callback_query}
+
+    def message(self, chat_id: int, user_id: int, text: str) -> Update:
+        return self._update(self.message_dict(chat_id, user_id, text))
+
+    def callback_query(self, chat_id: int, user_id: int, data: str, message_id: Optional[int] = None) -> Update:
+        return self._update(self.callback_query_dict(chat_id, user_id, data, message_id))
@@ -0,0 +1,115 @@
+"""Benchmark a Secret Santa with thousands of participants: memory, join/leave latency, rendering a page of the
+participants list, pickling, drafting and the bookkeeping of the chunked match delivery.
+
+Run from the repository root: python -m benchmarks.large_santa [PARTICIPANTS_COUNT ...]
+"""
+
+import logging
+import pickle
+import sys
+import time
+import tracemalloc
+
+# noinspection PyPackageRequirements
+from telegram import User
+
+import drafting
+from santa import SecretSanta
+
+DEFAULT_SIZES = (1_000, 10_000)
+OPERATIONS = 1_000
+PAGE_SIZE = 30
+CHUNK_SIZE = 100
+
+
+def timed(func, repeat: int = 1) -> float:
+    """Average seconds per call"""
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+
+    return (time.perf_counter() - start) / repeat
+
+
+def fake_santa() -> SecretSanta:
+    return SecretSanta(origin_message_id=1, user_id=1, user_name="user 1", chat_id=-1001, chat_title="company")
+
+
+def join(santa: SecretSanta, user_id: int):
+    user = User(user_id, f"user {user_id}", False)
+    santa.is_duplicate_name(user.first_name)
+    santa.add(user, join_message_id=10)
+
+
+def run(participants_count: int) -> dict:
+    results = {}
+
+    tracemalloc.start()
+    santa = fake_santa()
+    for user_id in range(1, participants_count + 1):
+        join(santa, user_id)
+    results["memory"] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    new_ids = iter(range(participants_count + 1, participants_count + OPERATIONS + 1))
+    results["join"] = timed(lambda: join(santa, next(new_ids)), OPERATIONS)
+
+    leaving_ids = iter(range(participants_count + 1, participants_count + OPERATIONS + 1))
+    results["leave"] = timed(lambda: santa.remove(next(leaving_ids)), OPERATIONS)
+
+    last_page = participants_count // PAGE_SIZE
+    results["first page"] = timed(lambda: santa.participants_page(0, PAGE_SIZE), 100)
+    results["last page"] = timed(lambda: santa.participants_page(last_page, PAGE_SIZE), 100)
+
+    blob = pickle.dumps(santa, protocol=pickle.HIGHEST_PROTOCOL)
+    results["pickle size"] = len(blob)
+    results["pickle"] = timed(lambda: pickle.dumps(santa, protocol=pickle.HIGHEST_PROTOCOL), 20)
+    results["unpickle"] = timed(lambda: pickle.loads(blob), 20)
+
+    pairs = []
+    results["draft"] = timed(lambda: pairs.extend(drafting.draft(list(santa.participants))))
+    for santa_id, receiver_id in pairs:
+        santa.set_user_receiver(santa_id, receiver_id)
+
+    def deliver():
+        chunks = 0
+        while True:
+            chunk = santa.pending_deliveries(CHUNK_SIZE)
+            if not chunk:
+                return chunks
+
+            for message_id, (santa_id, _) in enumerate(chunk, start=1):
+                santa.set_user_match_message_id(santa_id, message_id)
+            santa.delivery_progress()
+            chunks += 1
+
+    start = time.perf_counter()
+    chunks = deliver()
+    results["delivery chunk"] = (time.perf_counter() - start) / chunks
+
+    return results
+
+
+def main(sizes):
+    print(f"{'participants':>12} {'memory':>10} {'join':>9} {'leave':>9} {'first page':>11} {'last page':>11} "
+          f"{'pickle':>18} {'unpickle':>10} {'draft':>10} {'delivery chunk':>15}")
+    for participants_count in sizes:
+        r = run(participants_count)
+        print(
+            f"{participants_count:>12} "
+            f"{r['memory'] / 1024 ** 2:>8.2f}MB "
+            f"{r['join'] * 1e6:>7.1f}us "
+            f"{r['leave'] * 1e6:>7.1f}us "
+            f"{r['first page'] * 1e6:>9.1f}us "
+            f"{r['last page'] * 1e6:>9.1f}us "
+            f"{r['pickle'] * 1000:>6.2f}ms ({r['pickle size'] / 1024:>6.0f}KB) "
+            f"{r['unpickle'] * 1000:>8.2f}ms "
+            f"{r['draft'] * 1000:>8.2f}ms "
+            f"{r['delivery chunk'] * 1000:>13.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
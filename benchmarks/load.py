@@ -0,0 +1,245 @@
+"""End-to-end load test: the whole bot (main.main(): polling, keyed workers, outbound scheduler, connection pool,
+persistence) runs against a local Bot API stand-in (benchmarks.botapi), while N groups x M users are driven through
+/newsanta, joining and starting the match at a target rate of updates per second.
+
+Reports the throughput, the latency of the bot's reaction to each kind of update (the first message sent or the
+callback query answered), how long it took for every participant to receive their match, and the errors.
+
+Run from the repository root: python -m benchmarks.load [--groups 20] [--users 10] [--rate 50] [--latency 0.05]
+[--jitter 0.05] [--rate-limit 0.01] [--persistence pickle]
+
+The persistence files are written to a temporary directory. Logs below WARNING are disabled, unless --verbose.
+"""
+
+import argparse
+import bisect
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from benchmarks import fakebot
+from benchmarks.botapi import BotAPIServer
+from config import config
+
+GROUPS_BASE_ID = -1003000000000
+USERS_BASE_ID = 10_000_000
+NEWSANTA, JOIN, MATCH, DELIVERY = "newsanta", "join", "match", "delivery"
+
+
+class Step:
+    __slots__ = ("kind", "group_id", "chat_id", "update", "pushed_on")
+
+    def __init__(self, kind: str, group_id: int, chat_id: int, update: dict):
+        self.kind = kind
+        self.group_id = group_id
+        self.chat_id = chat_id  # where the bot answers
+        self.update = update
+        self.pushed_on: Optional[float] = None
+
+    @property
+    def callback_query_id(self) -> Optional[str]:
+        return self.update["callback_query"]["id"] if "callback_query" in self.update else None
+
+
+def scenario(groups: int, users: int) -> List[Step]:
+    """Every group goes through /newsanta, the joins of its users (the creator first) and the match. The groups
+    proceed together: the steps are interleaved"""
+
+    updates = fakebot.Updates()
+    groups_steps = []
+    for i in range(groups):
+        group_id = GROUPS_BASE_ID - i
+        creator_id = USERS_BASE_ID + i * users
+        steps = [Step(NEWSANTA, group_id, group_id, updates.message_dict(group_id, creator_id, "/newsanta"))]
+        for user_id in range(creator_id, creator_id + users):
+            steps.append(Step(JOIN, group_id, user_id, updates.message_dict(user_id, user_id, f"/start {group_id}")))
+        steps.append(Step(MATCH, group_id, group_id, updates.callback_query_dict(group_id, creator_id, "match")))
+
+        groups_steps.append(steps)
+
+    interleaved = []
+    for step_index in range(users + 2):
+        interleaved.extend(steps[step_index] for steps in groups_steps)
+
+    # the update ids have to increase in the order the updates are sent
+    for update_id, step in enumerate(interleaved, start=1):
+        step.update["update_id"] = update_id
+
+    return interleaved
+
+
+def push_updates(server: BotAPIServer, steps: List[Step], rate: float):
+    start = time.monotonic()
+    for i, step in enumerate(steps):
+        wait = start + i / rate - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        step.pushed_on = time.monotonic()
+        server.push(step.update)
+
+
+def first_after(times: List[float], after: float) -> Optional[float]:
+    index = bisect.bisect_left(times, after)
+    return times[index] if index < len(times) else None
+
+
+def latencies(server: BotAPIServer, steps: List[Step]) -> Dict[str, List[Optional[float]]]:
+    """Seconds from when each update was made available to when the bot reacted (None: it didn't)"""
+
+    sent = {chat_id: sorted(times) for chat_id, times in server.sent.items()}
+    result = defaultdict(list)
+    participants = defaultdict(list)
+    for step in steps:
+        if step.kind == MATCH:
+            answered_on = server.answered.get(step.callback_query_id)
+            result[MATCH].append(answered_on - step.pushed_on if answered_on else None)
+
+            # the second message sent to a participant is their match (the first one is the reply to their join)
+            delivered_on = [sent.get(user_id, [])[1:2] for user_id in participants[step.group_id]]
+            if all(delivered_on):
+                result[DELIVERY].append(max(times[0] for times in delivered_on) - step.pushed_on)
+            else:
+                result[DELIVERY].append(None)
+            continue
+
+        if step.kind == JOIN:
+            participants[step.group_id].append(step.chat_id)
+
+        reacted_on = first_after(sent.get(step.chat_id, []), step.pushed_on)
+        result[step.kind].append(reacted_on - step.pushed_on if reacted_on else None)
+
+    return result
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def stop_when_done(server: BotAPIServer, idle: float, timeout: float, pusher: threading.Thread):
+    """Stop the bot (like Ctrl+C would) once all the updates have been fetched and no Bot API call was made for
+    `idle` seconds, or after `timeout` seconds"""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(0.2)
+        if not pusher.is_alive() and server.all_fetched() and time.monotonic() - server.last_call > idle:
+            break
+    else:
+        print(f"timeout: stopping the bot after {timeout:.0f}s", file=sys.stderr)
+
+    os.kill(os.getpid(), signal.SIGINT)
+
+
+def report(server: BotAPIServer, steps: List[Step], elapsed: float, main_module):
+    results = latencies(server, steps)
+    reacted = sum(1 for kind in (NEWSANTA, JOIN, MATCH) for value in results[kind] if value is not None)
+
+    print(f"\n{len(steps)} updates in {elapsed:.1f}s: {reacted / elapsed:.1f} updates/s handled")
+    print(f"{'':<10} {'count':>6} {'no answer':>10} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for kind in (NEWSANTA, JOIN, MATCH, DELIVERY):
+        values = results[kind]
+        answered = sorted(value for value in values if value is not None)
+        if not answered:
+            print(f"{kind:<10} {len(values):>6} {len(values):>10}")
+            continue
+
+        p50, p90, p99 = (percentile(answered, p) * 1000 for p in (50, 90, 99))
+        print(f"{kind:<10} {len(values):>6} {len(values) - len(answered):>10} {p50:>7.0f}ms {p90:>7.0f}ms "
+              f"{p99:>7.0f}ms {answered[-1] * 1000:>7.0f}ms")
+
+    print("\nBot API calls: " + ", ".join(f"{method} {count}" for method, count in server.calls.most_common()))
+    print("429 injected: " + (", ".join(f"{method} {count}" for method, count in server.rate_limited.items()) or "none"))
+    print("errors: " + (", ".join(f"{method} {count}" for method, count in server.errors.items()) or "none"))
+
+    metrics = main_module.metrics.snapshot()
+    print("\nbot counters: " + ", ".join(f"{name} {value:.0f}" for name, value in metrics.items() if name.endswith("_total")))
+    print(f"outbound scheduler: {main_module.outbound_scheduler.stats()}")
+    print(f"handlers: {main_module.handler_latency.summary(limit=8)}")
+    print(f"Bot API: {main_module.api_latency.summary(limit=8)}")
+
+
+def run(args):
+    server = BotAPIServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        seed=args.seed
+    )
+    server.start()
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    config.telegram['token'] = fakebot.TOKEN
+    config.telegram['base_url'] = server.url
+    config.telegram['log_chat'] = 0
+    if args.workers:
+        config.telegram['workers'] = args.workers
+    config.santa['max_participants'] = 0
+    config.setdefault('persistence', {})
+    if args.persistence:
+        config.persistence['backend'] = args.persistence
+    config.persistence['pickle_file'] = os.path.join(tmp_dir.name, "data.pickle")
+    config.persistence['sqlite_file'] = os.path.join(tmp_dir.name, "data.sqlite")
+    config.persistence['archive_file'] = os.path.join(tmp_dir.name, "archive.sqlite")
+
+    import main  # only now: the bot and the persistence are created when the module is imported
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    steps = scenario(args.groups, args.users)
+    print(f"{args.groups} groups x {args.users} users: {len(steps)} updates at {args.rate}/s, "
+          f"Bot API latency {args.latency * 1000:.0f}ms (+{args.jitter * 1000:.0f}ms), 429 rate {args.rate_limit:.1%}, "
+          f"persistence: {config.persistence.get('backend', 'pickle')}", file=sys.stderr)
+
+    def start_load():
+        while not server.calls["getUpdates"]:  # wait for the bot to start polling
+            time.sleep(0.05)
+
+        pusher = threading.Thread(target=push_updates, args=(server, steps, args.rate), name="load_pusher")
+        pusher.start()
+        stop_when_done(server, args.idle, args.timeout, pusher)
+
+    threading.Thread(target=start_load, name="load", daemon=True).start()
+
+    main.main()  # returns when the bot is stopped
+    elapsed = max(server.last_call, steps[-1].pushed_on or 0) - steps[0].pushed_on
+
+    server.stop()
+    tmp_dir.cleanup()
+
+    report(server, steps, elapsed, main)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Run the bot against a local Bot API and measure it under load")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--users", type=int, default=10, help="participants per group (at least 2)")
+    parser.add_argument("--rate", type=float, default=50, help="updates per second")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every Bot API call")
+    parser.add_argument("--jitter", type=float, default=0.05, help="up to this many seconds added at random")
+    parser.add_argument("--rate-limit", type=float, default=0.01, help="probability that a sending call fails with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds in the 429 responses")
+    parser.add_argument("--persistence", choices=("pickle", "sqlite", "journal", "none"), help="default: from config.toml")
+    parser.add_argument("--workers", type=int, help="keyed workers, default: from config.toml")
+    parser.add_argument("--idle", type=float, default=3, help="seconds without Bot API calls after which the run is over")
+    parser.add_argument("--timeout", type=float, default=600, help="maximum seconds the run can last")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's logs")
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("at least 2 users per group are needed to draft the matches")
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
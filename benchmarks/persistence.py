@@ -0,0 +1,113 @@
+"""Compare PicklePersistence, SQLitePersistence and JournalPersistence: cold load time and the cost of persisting
+a single join.
+
+Run from the repository root: python -m benchmarks.persistence [CHATS_COUNT ...]
+"""
+
+import datetime
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+# noinspection PyPackageRequirements
+from telegram import User
+# noinspection PyPackageRequirements
+from telegram.ext import PicklePersistence
+
+from santa import SecretSanta, Participant
+from storage import SQLitePersistence, JournalPersistence, import_pickle
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+JOINS = 20
+
+
+def fake_santa(chat_id: int, participants_count: int = 10):
+    return SecretSanta(
+        origin_message_id=1,
+        user_id=0,
+        user_name="user 0",
+        chat_id=chat_id,
+        chat_title=f"group {chat_id}",
+        santa_message_id=2,
+        participants={user_id: Participant(f"user {user_id}", None, 10) for user_id in range(participants_count)},
+    )
+
+
+def fake_state(chats_count: int):
+    """One in three chats has an active Secret Santa, one in fifty muted us"""
+
+    chat_data = {}
+    for i in range(chats_count):
+        chat_id = -1000000000000 - i
+        chat_data[chat_id] = {}
+        if i % 3 == 0:
+            chat_data[chat_id]["active_secret_santa"] = fake_santa(chat_id)
+        if i % 50 == 0:
+            chat_data[chat_id]["muted"] = True
+
+    user_data = {user_id: {"blocked": True} for user_id in range(0, chats_count, 20)}
+    bot_data = {"recently_left": {-1000000000000 - i: datetime.datetime.now() for i in range(0, chats_count, 10)}}
+
+    return {"user_data": user_data, "chat_data": chat_data, "bot_data": bot_data, "conversations": {}}
+
+
+def join(chat_data: dict, chat_id: int, user_id: int):
+    santa: SecretSanta = chat_data[chat_id]["active_secret_santa"]
+    santa.add(User(user_id, f"user {user_id}", False), join_message_id=10)
+
+
+def run(persistence, chat_id: int):
+    start = time.perf_counter()
+    chat_data = persistence.get_chat_data()
+    persistence.get_user_data()
+    persistence.get_bot_data()
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in range(1000, 1000 + JOINS):
+        join(chat_data, chat_id, user_id)
+        persistence.update_chat_data(chat_id, chat_data[chat_id])
+        persistence.update_user_data(user_id, {})
+        persistence.update_bot_data(persistence.get_bot_data())
+    join_seconds = (time.perf_counter() - start) / JOINS
+
+    return load_seconds, join_seconds
+
+
+def main(sizes):
+    print(f"{'backend':<8} {'chats':>8} {'file size':>12} {'load':>10} {'per join':>12}")
+    for chats_count in sizes:
+        state = fake_state(chats_count)
+        chat_id = next(iter(state["chat_data"]))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pickle_file_path = os.path.join(tmp_dir, "data.pickle")
+            sqlite_file_path = os.path.join(tmp_dir, "data.sqlite")
+
+            with open(pickle_file_path, "wb") as f:
+                pickle.dump(state, f)
+            import_pickle(pickle_file_path, SQLitePersistence(sqlite_file_path))
+            import_pickle(pickle_file_path, JournalPersistence(tmp_dir))
+            snapshot_file_path = os.path.join(tmp_dir, "journal.snapshot")
+
+            backends = (
+                ("pickle", pickle_file_path, lambda: PicklePersistence(filename=pickle_file_path)),
+                ("sqlite", sqlite_file_path, lambda: SQLitePersistence(sqlite_file_path)),
+                ("journal", snapshot_file_path, lambda: JournalPersistence(tmp_dir)),
+            )
+            for name, file_path, persistence_factory in backends:
+                file_size = os.path.getsize(file_path)
+                persistence = persistence_factory()
+                load_seconds, join_seconds = run(persistence, chat_id)
+                persistence.flush()
+
+                print(f"{name:<8} {chats_count:>8} {file_size / 1024:>10.0f}kB {load_seconds:>9.3f}s "
+                      f"{join_seconds * 1000:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,170 @@
+"""Replay a capture of incoming updates ([capture] file in config.toml) through the real dispatcher and handlers,
+with the keyed workers and the job queue running, against the in-process fake Bot API of benchmarks.fakebot.
+The updates are fed at their original pace (--speed 1), faster or slower (--speed 10, --speed 0.5), or as fast as
+possible (--speed 0), so that the same traffic can be profiled offline and compared between persistence backends
+(--persistence) or numbers of workers (--workers).
+
+Run from the repository root: python -m benchmarks.replay CAPTURE_FILE [--speed 0] [--state persistence/data.pickle]
+[--output results.json]
+
+Without --state, the bot starts with no data: updates about Secret Santas created before the capture started will
+be answered as if they didn't exist. The persistence files are written to a temporary directory.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# noinspection PyPackageRequirements
+from telegram import Update
+
+from benchmarks import fakebot
+from capture import read_capture
+from config import config
+
+SETTLE_HORIZON = 15  # seconds: after the last update, wait for the jobs due within this time (eg. the debounced edits)
+
+
+def pending_jobs(job_queue, horizon: float) -> int:
+    now = time.time()
+    return sum(1 for job in job_queue.jobs() if job.next_t and job.next_t.timestamp() < now + horizon)
+
+
+def feed(dispatcher, bot, capture_file: str, speed: float) -> int:
+    first_arrival = None
+    start = time.monotonic()
+    count = 0
+    for arrival, update_dict in read_capture(capture_file):
+        if first_arrival is None:
+            first_arrival = arrival
+
+        if speed:
+            wait = start + (arrival - first_arrival) / speed - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+        dispatcher.update_queue.put(Update.de_json(update_dict, bot))
+        count += 1
+
+    return count
+
+
+def wait_for_idle(dispatcher, job_queue, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if dispatcher.update_queue.empty() and not pending_jobs(job_queue, SETTLE_HORIZON):
+            return
+
+        time.sleep(0.1)
+
+    print(f"timeout: still busy after {timeout:.0f}s", file=sys.stderr)
+
+
+def run(args) -> dict:
+    tmp_dir = tempfile.TemporaryDirectory()
+    pickle_file_path = os.path.join(tmp_dir.name, "data.pickle")
+    if args.state:
+        shutil.copyfile(args.state, pickle_file_path)  # imported by the sqlite/journal backends if they're used
+
+    config.telegram['token'] = fakebot.TOKEN
+    config.telegram['log_chat'] = 0
+    if args.workers:
+        config.telegram['workers'] = args.workers
+    config.setdefault('persistence', {})
+    if args.persistence:
+        config.persistence['backend'] = args.persistence
+    config.persistence['pickle_file'] = pickle_file_path
+    config.persistence['sqlite_file'] = os.path.join(tmp_dir.name, "data.sqlite")
+    config.persistence['archive_file'] = os.path.join(tmp_dir.name, "archive.sqlite")
+    config['capture'] = {'file': ''}  # don't capture the replay
+
+    import main  # only now: the bot and the persistence are created when the module is imported
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    request = fakebot.FakeRequest(delay=args.latency)
+    bot = fakebot.fake_ext_bot(request)
+    main.dispatcher.bot = bot
+    main.updater.bot = bot
+
+    main.setup(main.dispatcher)
+    main.job_queue.start()
+    ready = threading.Event()
+    dispatcher_thread = threading.Thread(target=main.dispatcher.start, kwargs={"ready": ready}, name="dispatcher")
+    dispatcher_thread.start()
+    ready.wait()
+
+    start = time.perf_counter()
+    count = feed(main.dispatcher, bot, args.capture_file, args.speed)
+    fed_in = time.perf_counter() - start
+
+    wait_for_idle(main.dispatcher, main.job_queue, args.timeout)
+    main.dispatcher.stop()  # the updates already queued to the keyed workers are processed first
+    dispatcher_thread.join()
+    main.job_queue.stop()
+    elapsed = time.perf_counter() - start
+
+    flush_seconds = 0.
+    persistence = main.dispatcher.persistence
+    if persistence:
+        flush_start = time.perf_counter()
+        main.dispatcher.update_persistence()
+        persistence.flush()
+        flush_seconds = time.perf_counter() - flush_start
+
+    main.santa_archive.close()
+    tmp_dir.cleanup()
+
+    handlers = {}
+    for name, calls, errors, values, max_value in main.handler_latency.report():
+        handlers[name] = {"count": calls, "errors": errors}
+        handlers[name].update({f"p{p}": round(value * 1000, 2) for p, value in zip(main.PERCENTILES, values)})
+        handlers[name]["max"] = round(max_value * 1000, 2)
+
+    return {
+        "capture": os.path.basename(args.capture_file),
+        "speed": args.speed,
+        "persistence": config.persistence.get('backend', 'pickle'),
+        "workers": config.telegram.get('workers', 1),
+        "latency": args.latency,
+        "updates": count,
+        "fed_seconds": round(fed_in, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_second": round(count / elapsed, 1) if elapsed else 0,
+        "flush_seconds": round(flush_seconds, 3),
+        "handlers_ms": handlers,
+        "bot_api_calls": dict(request.calls.most_common()),
+        "counters": {name: value for name, value in main.metrics.snapshot().items() if name.endswith("_total")},
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Replay captured updates through the bot, against a fake Bot API")
+    parser.add_argument("capture_file")
+    parser.add_argument("--speed", type=float, default=1, help="1: original pace, 0: as fast as possible")
+    parser.add_argument("--state", help="pickle persistence file to start from (eg. a copy taken when the capture started)")
+    parser.add_argument("--persistence", choices=("pickle", "sqlite", "journal", "none"), help="default: from config.toml")
+    parser.add_argument("--workers", type=int, help="keyed workers, default: from config.toml")
+    parser.add_argument("--latency", type=float, default=0., help="seconds added to every Bot API call")
+    parser.add_argument("--timeout", type=float, default=600, help="maximum seconds to wait for the bot to be idle")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's logs")
+    args = parser.parse_args()
+
+    results = run(args)
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+    print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
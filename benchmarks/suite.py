@@ -0,0 +1,347 @@
+"""Benchmark the hot paths, offline: the join/leave/match handlers run end to end against an in-process fake Bot
+API (benchmarks.fakebot), plus drafting, rendering and (de)serializing a Secret Santa, looking up a santa in a large
+chat_data and persisting a join with each persistence backend.
+
+Results are written as JSON (microseconds per operation), so they can be compared between versions:
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+
+Run from the repository root. With --compare the exit code is 1 if any operation got slower than the threshold.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import pickle
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# noinspection PyPackageRequirements
+from telegram import __version__ as ptb_version
+# noinspection PyPackageRequirements
+from telegram.ext import Job
+
+from benchmarks import fakebot
+from benchmarks import persistence as persistence_benchmark
+from config import config
+
+# importing main builds the bot and the dispatcher: no persistence, no archive file, and a token that passes the
+# validation (the requests go to the fake Bot API anyway)
+config.setdefault('persistence', {})
+config.persistence['backend'] = 'none'
+config.persistence['archive_file'] = ':memory:'
+config.telegram['token'] = fakebot.TOKEN
+config.telegram['log_chat'] = 0
+config.santa['max_participants'] = 0
+
+import drafting  # noqa: E402
+import main  # noqa: E402
+from santa import SecretSanta  # noqa: E402
+from storage import SafePicklePersistence, SQLitePersistence, JournalPersistence, import_pickle  # noqa: E402
+
+REPEAT = 5  # the median of the runs is reported
+DEFAULT_THRESHOLD = 0.5  # the sub-millisecond operations easily vary by 20-30% between runs
+GROUPS_BASE_ID = -1002000000000
+MATCH_PARTICIPANTS = 20
+CHAT_DATA_SIZE = 100_000
+PERSISTENCE_CHATS = 10_000
+
+
+def measure(func, number: int, repeat: int = REPEAT, setup=None) -> float:
+    """Median of the microseconds per call over `repeat` runs of `number` calls. setup() is called (untimed) before
+    each run, and its result is passed to func()"""
+
+    runs = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        for i in range(number):
+            func(state, i)
+        runs.append((time.perf_counter() - start) / number * 1_000_000)
+
+    return statistics.median(runs)
+
+
+class Bench:
+    def __init__(self):
+        self.request = fakebot.FakeRequest()
+        self.bot = fakebot.fake_ext_bot(self.request)
+        self.updates = fakebot.Updates(self.bot)
+
+        main.dispatcher.bot = self.bot
+        main.updater.bot = self.bot
+        main.register_handlers(main.dispatcher)
+
+        self._group_ids = iter(range(GROUPS_BASE_ID, GROUPS_BASE_ID - 10_000_000, -1))
+        self._user_ids = iter(range(1_000, 10_000_000))
+
+    def clear_jobs(self):
+        # the job queue is not running: drop the jobs scheduled by the handlers (eg. the coalesced edits)
+        main.job_queue.scheduler.remove_all_jobs()
+
+    def process(self, update):
+        main.dispatcher.process_update(update)
+
+    def new_santa(self, creator_id: int = 1) -> int:
+        chat_id = next(self._group_ids)
+        self.process(self.updates.message(chat_id, creator_id, "/newsanta"))
+        return chat_id
+
+    def join(self, chat_id: int, user_id: int):
+        self.process(self.updates.message(user_id, user_id, f"/start {chat_id}"))
+
+    def santa_with_participants(self, count: int) -> int:
+        chat_id = self.new_santa()
+        for _ in range(count):
+            self.join(chat_id, next(self._user_ids))
+
+        self.clear_jobs()
+        return chat_id
+
+    def deliver(self, chat_id: int):
+        santa_message_id = next(iter(main.dispatcher.bot_data[main.DELIVERING_SANTAS_KEY][chat_id]))
+        job = Job(main.deliver_matches, context=(chat_id, santa_message_id, None), job_queue=main.job_queue)
+        while main.find_delivering_santa(main.dispatcher.bot_data, chat_id, santa_message_id):
+            job.run(main.dispatcher)
+
+    # handlers round-trips
+
+    def new_santa_round_trip(self) -> float:
+        return measure(lambda _, i: self.new_santa(), 200, setup=self.clear_jobs)
+
+    def join_round_trip(self) -> float:
+        def setup():
+            self.clear_jobs()
+            return self.santa_with_participants(0), [next(self._user_ids) for _ in range(500)]
+
+        return measure(lambda state, i: self.join(state[0], state[1][i]), 500, setup=setup)
+
+    def leave_round_trip(self) -> float:
+        users_count = 500
+
+        def setup():
+            chat_id = self.santa_with_participants(0)
+            user_ids = [next(self._user_ids) for _ in range(users_count)]
+            for user_id in user_ids:
+                self.join(chat_id, user_id)
+            self.clear_jobs()
+
+            return chat_id, user_ids
+
+        def leave(state, i):
+            chat_id, user_ids = state
+            self.process(self.updates.callback_query(user_ids[i], user_ids[i], f"private:leave:{chat_id}"))
+
+        return measure(leave, users_count, setup=setup)
+
+    def match_round_trip(self) -> float:
+        """Starting a santa and delivering all its matches"""
+
+        santas_count = 20
+
+        def setup():
+            self.clear_jobs()
+            return [self.santa_with_participants(MATCH_PARTICIPANTS) for _ in range(santas_count)]
+
+        def match(chat_ids, i):
+            chat_id = chat_ids[i]
+            santa = main.get_active_santa(main.dispatcher.chat_data[chat_id])
+            self.process(self.updates.callback_query(chat_id, santa.creator_id, "match", santa.santa_message_id))
+            self.deliver(chat_id)
+
+        return measure(match, santas_count, setup=setup)
+
+
+def sample_santa(participants_count: int) -> SecretSanta:
+    santa = persistence_benchmark.fake_santa(-1001, participants_count)
+    santa.start()
+    return santa
+
+
+def draft(participants_count: int) -> float:
+    participants = list(range(participants_count))
+    return measure(lambda _, i: drafting.draft(participants), max(10_000 // participants_count, 5))
+
+
+def participants_html(participants_count: int) -> float:
+    """Rendered from scratch: the cached list and mentions are dropped before every call"""
+
+    santa = sample_santa(participants_count)
+
+    def render(_, i):
+        santa._participants_html = None
+        santa._mentions.clear()
+        santa.participants_html()
+
+    return measure(render, max(100_000 // participants_count, 10))
+
+
+def santa_dict(participants_count: int) -> float:
+    santa = sample_santa(participants_count)
+    return measure(lambda _, i: santa.dict(), max(100_000 // participants_count, 10))
+
+
+def santa_from_dict(participants_count: int) -> float:
+    santa_as_dict = sample_santa(participants_count).dict()
+    return measure(lambda _, i: SecretSanta.from_dict(santa_as_dict), max(100_000 // participants_count, 10))
+
+
+def santa_pickle(participants_count: int) -> float:
+    santa = sample_santa(participants_count)
+    return measure(lambda _, i: pickle.loads(pickle.dumps(santa)), max(100_000 // participants_count, 10))
+
+
+def find_santa_by_chat_id() -> float:
+    """Hits and misses over a chat_data with one santa every three chats"""
+
+    chat_data = persistence_benchmark.fake_state(CHAT_DATA_SIZE)["chat_data"]
+    main.chat_index.build(chat_data, count_participants=lambda value: SecretSanta.load(value).get_participants_count())
+
+    rng = random.Random(0)
+    chat_ids = rng.sample(list(chat_data), 10_000)
+    return measure(lambda _, i: main.find_santa_by_chat_id(chat_data, chat_ids[i]), len(chat_ids))
+
+
+def persist_join() -> dict:
+    """Microseconds to persist a join and to load the data, per backend"""
+
+    results = {}
+    state = persistence_benchmark.fake_state(PERSISTENCE_CHATS)
+    chat_id = next(iter(state["chat_data"]))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_file_path = os.path.join(tmp_dir, "data.pickle")
+        sqlite_file_path = os.path.join(tmp_dir, "data.sqlite")
+        with open(pickle_file_path, "wb") as f:
+            pickle.dump(state, f)
+        import_pickle(pickle_file_path, SQLitePersistence(sqlite_file_path))
+        import_pickle(pickle_file_path, JournalPersistence(tmp_dir))
+
+        backends = (
+            ("pickle", lambda: SafePicklePersistence(filename=pickle_file_path)),
+            ("sqlite", lambda: SQLitePersistence(sqlite_file_path)),
+            ("journal", lambda: JournalPersistence(tmp_dir)),
+        )
+        for name, persistence_factory in backends:
+            persistence = persistence_factory()
+            load_seconds, join_seconds = persistence_benchmark.run(persistence, chat_id)
+            persistence.flush()
+
+            results[f"persistence_load_{name}_{PERSISTENCE_CHATS}"] = load_seconds * 1_000_000
+            results[f"persistence_join_{name}_{PERSISTENCE_CHATS}"] = join_seconds * 1_000_000
+
+    return results
+
+
+def run_all(quick: bool = False) -> dict:
+    results = {}
+
+    def record(name: str, func, *args):
+        start = time.perf_counter()
+        value = func(*args)
+        if isinstance(value, dict):
+            results.update(value)
+        else:
+            results[name] = value
+        print(f"{name:<40} {time.perf_counter() - start:>7.1f}s", file=sys.stderr)
+
+    bench = Bench()
+    record("handler_new_santa", bench.new_santa_round_trip)
+    record("handler_join", bench.join_round_trip)
+    record("handler_leave", bench.leave_round_trip)
+    record(f"handler_match_{MATCH_PARTICIPANTS}", bench.match_round_trip)
+    bench.clear_jobs()
+
+    for participants_count in (10, 100) if quick else (10, 100, 1_000):
+        record(f"draft_{participants_count}", draft, participants_count)
+    for participants_count in (30, 1_000):
+        record(f"participants_html_{participants_count}", participants_html, participants_count)
+        record(f"santa_dict_{participants_count}", santa_dict, participants_count)
+        record(f"santa_from_dict_{participants_count}", santa_from_dict, participants_count)
+        record(f"santa_pickle_{participants_count}", santa_pickle, participants_count)
+
+    record(f"find_santa_by_chat_id_{CHAT_DATA_SIZE}", find_santa_by_chat_id)
+    if not quick:
+        record("persistence", persist_join)
+
+    return results
+
+
+def git_revision() -> str:
+    try:
+        import subprocess
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """(name, baseline, result, ratio) of the operations slower than baseline * (1 + threshold)"""
+
+    regressions = []
+    print(f"{'operation':<40} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for name, value in results.items():
+        baseline_value = baseline.get(name)
+        if not baseline_value:
+            print(f"{name:<40} {'-':>12} {value:>10.1f}µs")
+            continue
+
+        ratio = value / baseline_value
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = " <- slower"
+            regressions.append((name, baseline_value, value, ratio))
+        print(f"{name:<40} {baseline_value:>10.1f}µs {value:>10.1f}µs {ratio:>6.2f}x{flag}")
+
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the bot")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare the results with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"slowdown ratio reported as a regression (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--quick", action="store_true", help="skip the slowest benchmarks")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)  # the handlers log a lot, and the logging config of main.py is not for us
+
+    results = run_all(quick=args.quick)
+    report = {
+        "revision": git_revision(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "python-telegram-bot": ptb_version,
+        "platform": platform.platform(),
+        "unit": "µs/op",
+        "results": {name: round(value, 2) for name, value in results.items()},
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if not args.compare:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    with open(args.compare, "r") as f:
+        baseline = json.load(f)
+
+    print(f"baseline: {baseline.get('revision') or '?'} ({baseline.get('date')}), now: {report['revision'] or '?'}")
+    regressions = compare(results, baseline["results"], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} operations slower than {1 + args.threshold:.2f}x the baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
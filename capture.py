@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator, Tuple
+
+# noinspection PyPackageRequirements
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateCapture:
+    """Appends every incoming update to a JSONL file, one {"t": arrival unix time, "update": update dict} per line,
+    so the traffic can be replayed later (benchmarks.replay). Lines are buffered and flushed at most every
+    flush_interval seconds, to keep the cost off the polling thread"""
+
+    def __init__(self, file_path: str, flush_interval: float = 1.0):
+        self.file_path = file_path
+        self.flush_interval = flush_interval
+        self.count = 0
+
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._file = open(file_path, "a", encoding="utf-8")
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+        logger.info("capturing the incoming updates to %s", file_path)
+
+    def record(self, update: Update):
+        line = json.dumps({"t": round(time.time(), 3), "update": update.to_dict()}, ensure_ascii=False)
+        with self._lock:
+            if self._file.closed:
+                return
+
+            self._file.write(line + "\n")
+            self.count += 1
+
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+        logger.info("%d updates captured to %s", self.count, self.file_path)
+
+
+def read_capture(file_path: str) -> Iterator[Tuple[float, dict]]:
+    """(arrival time, update dict) of the updates of a capture, in the order they were received. A truncated last
+    line (eg. the bot was killed while writing it) is skipped"""
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("%s:%d: invalid line skipped", file_path, line_number)
+                continue
+
+            yield record["t"], record["update"]
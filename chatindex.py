@@ -0,0 +1,75 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ChatIndex:
+    """Keeps track of the chats with an active Secret Santa (and of how many participants they have) and of the chats
+    where we are muted, so that handlers running in private chats can look a group up, and stats can be read, without
+    walking the whole dispatcher's chat_data"""
+
+    def __init__(self, active_santa_key: str, muted_key: str):
+        self.active_santa_key = active_santa_key
+        self.muted_key = muted_key
+
+        self._active_santas = set()
+        self._muted = set()
+        self._participants = {}  # chat_id -> participants count of its active santa
+        self._participants_total = 0
+        self._participants_lock = threading.Lock()  # santas of different chats change concurrently
+
+    def build(self, dispatcher_chat_data: dict, count_participants: Optional[Callable[[object], int]] = None):
+        """Populate the index from the chat_data loaded from the persistence. Meant to be called once, at startup.
+        count_participants(santa) returns the number of participants of an active santa, as found in chat_data"""
+
+        self._active_santas = set()
+        self._muted = set()
+        self._participants = {}
+        self._participants_total = 0
+        for chat_id, chat_data in dispatcher_chat_data.items():
+            if self.active_santa_key in chat_data:
+                self._active_santas.add(chat_id)
+                if count_participants:
+                    self.set_participants(chat_id, count_participants(chat_data[self.active_santa_key]))
+            if self.muted_key in chat_data:
+                self._muted.add(chat_id)
+
+        logger.info("chat index built: %d active santas, %d muted chats", len(self._active_santas), len(self._muted))
+
+    def add_santa(self, chat_id: int):
+        self._active_santas.add(chat_id)
+
+    def remove_santa(self, chat_id: int):
+        self._active_santas.discard(chat_id)
+        with self._participants_lock:
+            self._participants_total -= self._participants.pop(chat_id, 0)
+
+    def has_santa(self, chat_id: int) -> bool:
+        return chat_id in self._active_santas
+
+    def active_santas_count(self) -> int:
+        return len(self._active_santas)
+
+    def set_participants(self, chat_id: int, count: int):
+        with self._participants_lock:
+            self._participants_total += count - self._participants.get(chat_id, 0)
+            self._participants[chat_id] = count
+
+    def participants_count(self) -> int:
+        """Participants of all the active santas"""
+
+        return self._participants_total
+
+    def add_muted(self, chat_id: int):
+        self._muted.add(chat_id)
+
+    def remove_muted(self, chat_id: int):
+        self._muted.discard(chat_id)
+
+    def is_muted(self, chat_id: int) -> bool:
+        return chat_id in self._muted
+
+    def muted_count(self) -> int:
+        return len(self._muted)
@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import threading
+import time
+from typing import Callable, Hashable, Optional
+
+from apscheduler.jobstores.base import JobLookupError
+# noinspection PyPackageRequirements
+from telegram import InlineKeyboardMarkup
+# noinspection PyPackageRequirements
+from telegram.ext import JobQueue, CallbackContext, Job
+
+logger = logging.getLogger(__name__)
+
+
+def remove_job(job: Job):
+    try:
+        job.schedule_removal()
+    except JobLookupError:
+        # the job is already running: _run() will notice it's not the pending one anymore
+        pass
+
+
+class EditCoalescer:
+    """Collapses bursts of edits of the same message into one: an edit scheduled for a key runs debounce seconds
+    after the last request for that key, but never later than max_latency seconds after the first pending request.
+    It also remembers what was last sent for each key, so edits that wouldn't change anything can be skipped"""
+
+    def __init__(self, job_queue: JobQueue, debounce: float = 2.0, max_latency: float = 10.0):
+        self.job_queue = job_queue
+        self.debounce = debounce
+        self.max_latency = max_latency
+
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> (job, time of the first pending request)
+        self._key_locks = {}  # key -> lock held while the edit for that key is being sent
+        self._last_sent = {}  # key -> digest of the last text + reply markup sent
+
+    def _key_lock(self, key: Hashable) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def schedule(self, key: Hashable, callback: Callable[[CallbackContext], None]):
+        now = time.monotonic()
+        with self._lock:
+            first_request = now
+            if key in self._pending:
+                job, first_request = self._pending[key]
+                remove_job(job)
+
+            run_in = min(self.debounce, first_request + self.max_latency - now)
+            job = self.job_queue.run_once(self._run, max(run_in, 0), context=(key, callback))
+            self._pending[key] = (job, first_request)
+
+        logger.debug("edit for %s scheduled in %.2fs", key, run_in)
+
+    def _run(self, context: CallbackContext):
+        key, callback = context.job.context
+        with self._lock:
+            pending = self._pending.get(key)
+            if not pending or pending[0] is not context.job:
+                return  # rescheduled or cancelled meanwhile
+
+            self._pending.pop(key)
+
+        with self._key_lock(key):
+            callback(context)
+
+    def cancel(self, key: Hashable):
+        """Drop the pending edit for a key (if any), wait for an edit being sent to complete and forget what was
+        sent. To be called before the message is edited for the last time, so a late edit can't overwrite it"""
+
+        with self._lock:
+            pending = self._pending.pop(key, None)
+
+        if pending:
+            remove_job(pending[0])
+
+        with self._key_lock(key):
+            pass
+
+        with self._lock:
+            self._key_locks.pop(key, None)
+            self._last_sent.pop(key, None)
+
+    @staticmethod
+    def _digest(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> bytes:
+        reply_markup_json = reply_markup.to_json() if reply_markup else ""
+        return hashlib.blake2b(f"{text}\n{reply_markup_json}".encode(), digest_size=16).digest()
+
+    def is_unchanged(self, key: Hashable, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> bool:
+        return self._last_sent.get(key) == self._digest(text, reply_markup)
+
+    def sent(self, key: Hashable, text: str, reply_markup: Optional[InlineKeyboardMarkup]):
+        self._last_sent[key] = self._digest(text, reply_markup)
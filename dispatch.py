@@ -0,0 +1,111 @@
+import logging
+import threading
+from queue import Queue
+from typing import Callable, Hashable, List, Optional
+
+# noinspection PyPackageRequirements
+from telegram import Update
+# noinspection PyPackageRequirements
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDispatcher(Dispatcher):
+    """Dispatcher that processes updates on `keyed_workers` threads. Every update is assigned a key by key_func:
+    updates with the same key always go to the same thread, so they are processed one at a time and in the order
+    they were received, while updates with different keys can be processed in parallel.
+    Jobs can use run_keyed() to serialize their work with the updates of a key. If on_update is passed, it's called
+    with every update as soon as it's received, before it's queued (eg. to capture the traffic)"""
+
+    def __init__(
+            self,
+            *args,
+            key_func: Callable[[Update], Hashable],
+            keyed_workers: int = 1,
+            on_update: Optional[Callable[[Update], None]] = None,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.key_func = key_func
+        self.keyed_workers = max(1, keyed_workers)
+        self.on_update = on_update
+
+        self._keyed_queues: List[Queue] = []
+        self._keyed_threads: List[threading.Thread] = []
+
+    def _queue_for(self, key: Hashable) -> Queue:
+        return self._keyed_queues[hash(key) % len(self._keyed_queues)]
+
+    def _keyed_worker(self, queue: Queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                logger.error("error while running keyed work", exc_info=True)
+
+    def _start_keyed_workers(self):
+        for i in range(self.keyed_workers):
+            queue = Queue()
+            thread = threading.Thread(target=self._keyed_worker, args=(queue,), name=f"keyed_worker_{i}", daemon=True)
+            self._keyed_queues.append(queue)
+            self._keyed_threads.append(thread)
+            thread.start()
+
+        logger.info("started %d keyed workers", self.keyed_workers)
+
+    def _stop_keyed_workers(self):
+        # the sentinel is queued after the pending items: everything already received is processed
+        for queue in self._keyed_queues:
+            queue.put(None)
+
+        for thread in self._keyed_threads:
+            thread.join()
+
+        self._keyed_queues = []
+        self._keyed_threads = []
+
+    def start(self, ready: threading.Event = None) -> None:
+        if not self.running:
+            self._start_keyed_workers()
+
+        super().start(ready=ready)
+
+    def stop(self) -> None:
+        super().stop()
+        self._stop_keyed_workers()
+
+    def run_keyed(self, key: Hashable, func: Callable, *args):
+        """Run func(*args) on the thread that processes the updates with this key. If the workers are not
+        running, func is called immediately"""
+
+        if not self._keyed_queues:
+            func(*args)
+            return
+
+        self._queue_for(key).put((func, args))
+
+    def process_update(self, update: object) -> None:
+        if self.on_update and isinstance(update, Update):
+            try:
+                self.on_update(update)
+            except Exception:
+                logger.error("error in on_update for update %d", update.update_id, exc_info=True)
+
+        # errors put in the update queue (eg. from the polling thread) are handled as usual
+        if not isinstance(update, Update) or not self._keyed_queues:
+            super().process_update(update)
+            return
+
+        try:
+            key = self.key_func(update)
+        except Exception:
+            logger.error("error while computing the key of update %d", update.update_id, exc_info=True)
+            key = None
+
+        self.run_keyed(key, super().process_update, update)
@@ -0,0 +1,177 @@
+import logging
+import random
+from collections import deque
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+Exclusions = Dict[Hashable, Set[Hashable]]  # santa -> receivers they must not be assigned
+
+EMPTY = frozenset()
+
+
+class DraftInfeasible(Exception):
+    """There is no assignment that respects the exclusions: `santa` can't be given a receiver"""
+
+    def __init__(self, santa: Hashable):
+        super().__init__(f"no valid receiver can be assigned to {santa}")
+        self.santa = santa
+
+
+def exclusions_from_pairs(pairs: Iterable[Tuple[Hashable, Hashable]], symmetric: bool = False) -> Exclusions:
+    """Build the exclusions from (santa, receiver) pairs. With symmetric=True, each pair excludes both directions
+    (eg. couples)"""
+
+    exclusions = {}
+    for santa, receiver in pairs:
+        exclusions.setdefault(santa, set()).add(receiver)
+        if symmetric:
+            exclusions.setdefault(receiver, set()).add(santa)
+
+    return exclusions
+
+
+def merge_exclusions(*exclusions_list: Exclusions) -> Exclusions:
+    merged = {}
+    for exclusions in exclusions_list:
+        for santa, receivers in exclusions.items():
+            merged.setdefault(santa, set()).update(receivers)
+
+    return merged
+
+
+def is_valid(santa: Hashable, receiver: Hashable, exclusions: Exclusions) -> bool:
+    return santa != receiver and receiver not in exclusions.get(santa, EMPTY)
+
+
+def sample(participants: List[Hashable], exclusions: Exclusions, rng: random.Random) -> Optional[List[Tuple]]:
+    """One attempt of rejection sampling: a random permutation, built one position at a time (Fisher-Yates) and
+    abandoned at the first invalid pair. Accepted permutations are uniformly distributed among the valid ones"""
+
+    receivers = list(participants)
+    count = len(receivers)
+    for i, santa in enumerate(participants):
+        j = rng.randrange(i, count)
+        receivers[i], receivers[j] = receivers[j], receivers[i]
+        if not is_valid(santa, receivers[i], exclusions):
+            return None
+
+    return list(zip(participants, receivers))
+
+
+def _augment(
+        start: Hashable,
+        participants: List[Hashable],
+        exclusions: Exclusions,
+        receiver_of: dict,
+        santa_of: dict
+) -> bool:
+    """Look for an augmenting path from the unassigned santa `start` with a breadth-first search, and apply it.
+    The graph is walked through its complement: every receiver is visited at most once, and every receiver skipped
+    for a santa is charged to one of that santa's exclusions. Each search costs O(participants + exclusions)"""
+
+    reached_from = {}  # receiver -> santa it was reached from
+    unvisited = list(participants)
+    queue = deque([start])
+    while queue:
+        santa = queue.popleft()
+        excluded = exclusions.get(santa, EMPTY)
+        still_unvisited = []
+        free_receiver = None
+        for receiver in unvisited:
+            if receiver == santa or receiver in excluded:
+                still_unvisited.append(receiver)
+                continue
+
+            reached_from[receiver] = santa
+            if receiver not in santa_of:
+                free_receiver = receiver
+                break
+
+            queue.append(santa_of[receiver])
+
+        if free_receiver is not None:
+            receiver = free_receiver
+            while True:
+                santa = reached_from[receiver]
+                previous_receiver = receiver_of.get(santa)
+                receiver_of[santa] = receiver
+                santa_of[receiver] = santa
+                if santa == start:
+                    return True
+
+                receiver = previous_receiver
+
+        unvisited = still_unvisited
+
+    return False
+
+
+def match(participants: List[Hashable], exclusions: Exclusions, rng: random.Random, greedy_picks: int = 8) -> List[Tuple]:
+    """Find a valid assignment in polynomial time, or raise DraftInfeasible. Santas are first given a random free
+    receiver (up to greedy_picks tries each), then the ones left are assigned through augmenting paths. Randomized,
+    but not uniform"""
+
+    santas = list(participants)
+    rng.shuffle(santas)
+    free_receivers = list(participants)
+    rng.shuffle(free_receivers)
+
+    receiver_of = {}
+    santa_of = {}
+    left = []
+    for santa in santas:
+        for _ in range(greedy_picks):
+            index = rng.randrange(len(free_receivers))
+            receiver = free_receivers[index]
+            if is_valid(santa, receiver, exclusions):
+                free_receivers[index] = free_receivers[-1]
+                free_receivers.pop()
+                receiver_of[santa] = receiver
+                santa_of[receiver] = santa
+                break
+        else:
+            left.append(santa)
+
+    logger.debug("greedy assignment left %d santas without a receiver", len(left))
+
+    receivers_order = list(participants)
+    rng.shuffle(receivers_order)
+    for santa in left:
+        if santa in receiver_of:
+            continue
+
+        if not _augment(santa, receivers_order, exclusions, receiver_of, santa_of):
+            # no augmenting path from this santa: no assignment can include it (Berge)
+            raise DraftInfeasible(santa)
+
+    return [(santa, receiver_of[santa]) for santa in participants]
+
+
+def draft(
+        participants: Iterable[Hashable],
+        exclusions: Optional[Exclusions] = None,
+        sampling_attempts: int = 100,
+        rng: Optional[random.Random] = None
+) -> List[Tuple]:
+    """Assign a receiver to every participant: nobody gets themselves, and nobody gets someone in their exclusions.
+    Returns a list of (santa, receiver) pairs.
+    The result is drawn uniformly among all the valid assignments, through rejection sampling, if one of the
+    sampling_attempts is accepted (that's likely unless the exclusions are dense). Otherwise, a valid assignment is
+    built through bipartite matching. If none exists, DraftInfeasible is raised: this doesn't depend on luck"""
+
+    participants = list(participants)
+    exclusions = exclusions or {}
+    rng = rng or random.Random()
+
+    if len(participants) < 2:
+        raise DraftInfeasible(participants[0] if participants else None)
+
+    for attempt in range(1, sampling_attempts + 1):
+        pairs = sample(participants, exclusions, rng)
+        if pairs:
+            logger.debug("uniform sample accepted after %d attempts", attempt)
+            return pairs
+
+    logger.debug("no uniform sample accepted after %d attempts: matching", sampling_attempts)
+    return match(participants, exclusions, rng)
@@ -0,0 +1,113 @@
+import datetime
+import heapq
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+# noinspection PyPackageRequirements
+from telegram.ext import JobQueue, CallbackContext, Job
+
+import utilities
+from coalescer import remove_job
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """Fires when the active Secret Santas expire. The deadlines are kept in a chat_id -> deadline dict, meant to be
+    stored in bot_data so it's persisted and doesn't need to be rebuilt from chat_data, and in a min-heap. A single
+    job is scheduled, for the earliest deadline: when it runs, only the santas that are due are popped from the heap
+    and passed to on_expired(context, chat_id), then the job is scheduled again for the next deadline.
+    Removed or changed deadlines are dropped from the heap lazily, when they reach its top"""
+
+    def __init__(self, on_expired: Callable[[CallbackContext, int], None]):
+        self.on_expired = on_expired
+
+        self.job_queue: Optional[JobQueue] = None
+        self._deadlines: Dict[int, datetime.datetime] = {}
+        self._heap = []  # (deadline, chat_id)
+        self._job: Optional[Job] = None
+        self._job_deadline: Optional[datetime.datetime] = None
+        self._lock = threading.RLock()
+
+        self.fired = 0
+
+    def load(self, job_queue: JobQueue, deadlines: Dict[int, datetime.datetime]):
+        """Start from the deadlines loaded from the persistence. The dict is kept and updated in place"""
+
+        with self._lock:
+            self.job_queue = job_queue
+            self._deadlines = deadlines
+            self._heap = [(deadline, chat_id) for chat_id, deadline in deadlines.items()]
+            heapq.heapify(self._heap)
+            self._schedule()
+
+        logger.info("expiry scheduler loaded: %d deadlines", len(self._deadlines))
+
+    def _is_current(self, deadline: datetime.datetime, chat_id: int) -> bool:
+        return self._deadlines.get(chat_id) == deadline
+
+    def _schedule(self):
+        """Make sure the job runs at the earliest deadline. The lock must be held"""
+
+        while self._heap and not self._is_current(*self._heap[0]):
+            heapq.heappop(self._heap)
+
+        next_deadline = self._heap[0][0] if self._heap else None
+        if next_deadline == self._job_deadline or not self.job_queue:
+            return
+
+        if self._job:
+            remove_job(self._job)
+            self._job = None
+
+        self._job_deadline = next_deadline
+        if next_deadline is not None:
+            run_in = max((next_deadline - utilities.now()).total_seconds(), 0)
+            self._job = self.job_queue.run_once(self._run, run_in)
+            logger.debug("next expiry in %.0fs", run_in)
+
+    def set(self, chat_id: int, deadline: datetime.datetime):
+        with self._lock:
+            if self._deadlines.get(chat_id) == deadline:
+                return
+
+            self._deadlines[chat_id] = deadline
+            heapq.heappush(self._heap, (deadline, chat_id))
+            if self._job_deadline is None or deadline < self._job_deadline:
+                self._schedule()
+
+    def remove(self, chat_id: int):
+        with self._lock:
+            self._deadlines.pop(chat_id, None)
+
+    def deadline(self, chat_id: int) -> Optional[datetime.datetime]:
+        return self._deadlines.get(chat_id)
+
+    def _run(self, context: CallbackContext):
+        due = []
+        with self._lock:
+            if self._job is not context.job:
+                return  # rescheduled meanwhile
+
+            self._job = None
+            self._job_deadline = None
+
+            now = utilities.now()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, chat_id = heapq.heappop(self._heap)
+                if self._is_current(deadline, chat_id):
+                    due.append(chat_id)
+
+            self._schedule()
+
+        logger.info("%d Secret Santas expired", len(due))
+        for chat_id in due:
+            self.fired += 1
+            try:
+                self.on_expired(context, chat_id)
+            except Exception as e:
+                logger.error("error while expiring the Secret Santa of %d: %s", chat_id, str(e), exc_info=True)
+
+    def __len__(self):
+        return len(self._deadlines)
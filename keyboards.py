@@ -1,10 +1,45 @@
+from functools import lru_cache
+
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Message
 
 from emojis import Emoji
 from config import config
 
+CACHE_SIZE = 4096  # secret_santa() keyboards have at most four shapes per chat
 
-def secret_santa(chat_id: int, bot_username: str, participants_count: int = 0):
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """InlineKeyboardMarkup that is serialized only once: the keyboards below are cached and shared, they must not
+    be modified"""
+
+    __slots__ = ("_json",)
+
+    def __init__(self, inline_keyboard, **kwargs):
+        super().__init__(inline_keyboard, **kwargs)
+        self._json = None
+
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = super().to_json()
+
+        return self._json
+
+
+def participants_tier(participants_count: int) -> int:
+    """The buttons of the santa message depend only on this"""
+
+    if participants_count > config.santa.get('large_threshold', 30) and participants_count >= config.santa.min_participants:
+        return 3
+    elif participants_count >= config.santa.min_participants:
+        return 2
+    elif participants_count:
+        return 1
+
+    return 0
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _secret_santa(chat_id: int, bot_username: str, tier: int):
     # knowing the message id is not really needed because a caht can only have one ongoing secret chat
     deeplink_url = f"https://t.me/{bot_username}?start={chat_id}"
     keyboard = [
@@ -12,19 +47,28 @@ def secret_santa(chat_id: int, bot_username: str, participants_count: int = 0):
         [InlineKeyboardButton(f"{Emoji.CROSS} cancel", callback_data=f"cancel")],
     ]
 
-    if participants_count:
+    if tier >= 1:
         unsubscribe_button = InlineKeyboardButton(f"{Emoji.FREEZE} leave", callback_data=f"leave")
         keyboard[0].append(unsubscribe_button)
 
-    if participants_count >= config.santa.min_participants:
+    if tier >= 2:
         start_button = InlineKeyboardButton(f"{Emoji.SANTA} start match", callback_data=f"match")
         keyboard[1].append(start_button)
 
-    return InlineKeyboardMarkup(keyboard)
+    if tier >= 3:
+        # the list is not in the message anymore: it's sent page by page in the private chat
+        keyboard.append([InlineKeyboardButton(f"{Emoji.LIST} participants", callback_data=f"participants")])
+
+    return FrozenInlineKeyboardMarkup(keyboard)
+
+
+def secret_santa(chat_id: int, bot_username: str, participants_count: int = 0):
+    return _secret_santa(chat_id, bot_username, participants_tier(participants_count))
 
 
+@lru_cache(maxsize=CACHE_SIZE)
 def joined_message(chat_id: int):
-    return InlineKeyboardMarkup(
+    return FrozenInlineKeyboardMarkup(
         [[
             InlineKeyboardButton(f"{Emoji.FREEZE} leave", callback_data=f"private:leave:{chat_id}"),
             InlineKeyboardButton(f"{Emoji.LIST} update your name", callback_data=f"private:updatename:{chat_id}")
@@ -32,10 +76,29 @@ def joined_message(chat_id: int):
     )
 
 
+@lru_cache(maxsize=CACHE_SIZE)
+def participants_page(chat_id: int, page: int, pages_count: int):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"private:participants:{chat_id}:{page - 1}"))
+    if page < pages_count - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"private:participants:{chat_id}:{page + 1}"))
+
+    if not buttons:
+        return None
+
+    return FrozenInlineKeyboardMarkup([buttons])
+
+
+@lru_cache(maxsize=None)
 def revoke():
-    return InlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.CROSS} revoke", callback_data=f"revoke")]])
+    return FrozenInlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.CROSS} revoke", callback_data=f"revoke")]])
 
 
+@lru_cache(maxsize=None)
 def new_santa():
-    return InlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.TREE} new Secret Santa", callback_data=f"newsanta")]])
+    return FrozenInlineKeyboardMarkup([[InlineKeyboardButton(f"{Emoji.TREE} new Secret Santa", callback_data=f"newsanta")]])
+
 
+def cache_info() -> dict:
+    return {"secret_santa": _secret_santa.cache_info()._asdict(), "joined_message": joined_message.cache_info()._asdict()}
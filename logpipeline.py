@@ -0,0 +1,103 @@
+import atexit
+import itertools
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through only one every N DEBUG records, for the loggers (or "logger:function") in `rates`, eg.
+    {"main:find_santa_by_chat_id": 100}. Records from INFO up are never dropped"""
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = rates
+        self._counters = {}
+
+    def _counter(self, key: str):
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters.setdefault(key, itertools.count())
+
+        return counter
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.INFO:
+            return True
+
+        key = f"{record.name}:{record.funcName}"
+        rate = self.rates.get(key)
+        if rate is None:
+            key = record.name
+            rate = self.rates.get(key)
+
+        if not rate or rate <= 1:
+            return True
+
+        return next(self._counter(key)) % rate == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler with a bounded queue: when the listener can't keep up, records are dropped instead of blocking
+    the thread that logs. How many were dropped is logged as soon as there's room again"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._unreported = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+            return
+
+        if self._unreported:
+            with self._lock:
+                unreported, self._unreported = self._unreported, 0
+
+            if unreported:
+                warning = logging.LogRecord(
+                    __name__, logging.WARNING, __file__, 0, "%d log records dropped: the logging queue was full",
+                    (unreported,), None
+                )
+                try:
+                    self.queue.put_nowait(self.prepare(warning))
+                except queue.Full:
+                    pass
+
+
+def start_queue_listener(max_size: int = 10000, sampling: Optional[Dict[str, int]] = None) -> QueueListener:
+    """Move the handlers of the root logger behind a queue: the threads that log only format the message and put it
+    on the queue, the handlers (disk I/O, rotation) run on the listener's thread. The listener is stopped (and the
+    queue emptied) at exit"""
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(max_size))
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
+
+
+def add_sampling(sampling: Dict[str, int]):
+    """Sample the records of the handlers of the root logger, without a queue"""
+
+    sampling_filter = SamplingFilter(sampling)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(sampling_filter)
@@ -10,23 +10,34 @@ import threading
 import time
 from functools import wraps
 from pathlib import Path
+from queue import Queue
 from random import choice
-from typing import List, Callable, Optional, Union
+from typing import List, Callable, Optional
 
 from telegram import Update, TelegramError, Chat, ParseMode, Bot, BotCommandScopeAllPrivateChats, BotCommand, User, \
     BotCommandScopeAllChatAdministrators, ChatAction, ChatMemberLeft, ChatMemberUpdated, ChatMemberMember, \
     BotCommandScopeChatAdministrators, ChatMember
 from telegram.error import BadRequest
 from telegram.ext import Updater, CallbackContext, Filters, MessageHandler, CallbackQueryHandler, MessageFilter, \
-    CommandHandler, ExtBot, Defaults, ChatMemberHandler
-from telegram.utils.request import Request
+    CommandHandler, ExtBot, Defaults, ChatMemberHandler, Dispatcher, JobQueue
 
+import drafting
 import keyboards
+import logpipeline
+import ratelimit
 import utilities
+from admins import AdminCache
+from archive import SantaArchive
+from capture import UpdateCapture
+from chatindex import ChatIndex
+from coalescer import EditCoalescer
+from dispatch import KeyedDispatcher
 from emojis import Emoji
+from expiry import ExpiryScheduler
+from metrics import Metrics, DailyCounter, serve as serve_metrics
+from perf import LatencyRecorder, PERCENTILES, timed
 from santa import SecretSanta
-from santa import NAME_MAX_LENGTH
-from mwt import MWT
+from santa import NAME_MAX_LENGTH, NOT_DELIVERED
 from config import config
 
 ACTIVE_SECRET_SANTA_KEY = "active_secret_santa"
@@ -34,7 +45,9 @@ MUTED_KEY = "muted"
 REMOVED_KEY = "removed"
 BLOCKED_KEY = "blocked"
 RECENTLY_LEFT_KEY = "recently_left"
-RECENTLY_STARTED_SANTAS_KEY = "recently_closed_santas"
+RECENTLY_STARTED_SANTAS_KEY = "recently_closed_santas"  # before the archive: only read to migrate them
+DELIVERING_SANTAS_KEY = "delivering_santas"
+EXPIRY_DEADLINES_KEY = "expiry_deadlines"
 
 EMPTY_SECRET_SANTA_STR = f'{Emoji.SANTA}{Emoji.TREE} لم ينضم أحد إلى هذا السر سانتا بعد! استخدم زر "<b>انضم</b>" أدناه للانضمام'
 
@@ -70,17 +83,104 @@ class Commands:
     ]
 
 
-updater = Updater(
-    bot=ExtBot(
+startup_timings = {}
+
+outbound_scheduler = ratelimit.OutboundScheduler()
+
+handler_latency = LatencyRecorder()  # handlers, jobs and the slowest steps inside them
+api_latency = LatencyRecorder()  # Bot API calls, per method
+
+
+def santa_key(update: Update) -> int:
+    """Updates that can touch the same Secret Santa get the same key, the id of its group: private chat buttons and
+    deeplinks carry the id of the group they refer to"""
+
+    if update.callback_query and update.callback_query.data:
+        match = re.search(r"^private:\w+:(-\d+)(?::|$)", update.callback_query.data)
+        if match:
+            return int(match.group(1))
+
+    if update.message and update.message.text and update.effective_chat.type == Chat.PRIVATE:
+        match = re.search(r"^/start (-?\d+)", update.message.text)
+        if match:
+            return int(match.group(1))
+
+    if update.effective_chat:
+        return update.effective_chat.id
+
+    return update.effective_user.id if update.effective_user else 0
+
+
+# opt-in: every incoming update is appended to a JSONL file, to be replayed with benchmarks.replay
+update_capture = UpdateCapture(config['capture']['file']) if config.get('capture', {}).get('file', '') else None
+
+with utilities.timer(startup_timings, "load"):
+    bot = ExtBot(
         token=config.telegram.token,
+        base_url=config.telegram.get('base_url', None),
         defaults=Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True),
-        request=Request(con_pool_size=config.telegram.get('workers', 1) + 4)
-    ),
-    workers=0,
-    persistence=utilities.persistence_object()
+        request=ratelimit.ScheduledRequest(
+            outbound_scheduler,
+            recorder=api_latency,
+            con_pool_size=config.telegram.get('workers', 1) + config.telegram.get('fan_out_workers', 8) + 4
+        )
+    )
+    job_queue = JobQueue()
+    dispatcher = KeyedDispatcher(
+        bot,
+        Queue(),
+        workers=0,  # no run_async pool: updates are processed by the keyed workers
+        job_queue=job_queue,
+        persistence=utilities.persistence_object(),
+        key_func=santa_key,
+        keyed_workers=config.telegram.get('workers', 1),
+        on_update=update_capture.record if update_capture else None,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+
+chat_index = ChatIndex(ACTIVE_SECRET_SANTA_KEY, MUTED_KEY)
+
+started_today = DailyCounter()
+
+# kept up to date by the handlers, read by /ongoing and by the metrics endpoint
+metrics = Metrics()
+metrics.gauge("active_santas", "Secret Santas not started yet", chat_index.active_santas_count)
+metrics.gauge("participants", "Participants of the Secret Santas not started yet", chat_index.participants_count)
+metrics.gauge("muted_chats", "Groups where the bot can't send messages", chat_index.muted_count)
+metrics.gauge("started_today", "Secret Santas started today", started_today.value)
+metrics.counter("santas_created_total", "Secret Santas created")
+metrics.counter("santas_started_total", "Secret Santas started")
+metrics.counter("santas_cancelled_total", "Secret Santas cancelled")
+metrics.counter("santas_expired_total", "Secret Santas closed because they were not started in time")
+metrics.counter("joins_total", "Participants that joined a Secret Santa")
+metrics.counter("leaves_total", "Participants that left a Secret Santa")
+metrics.counter("matches_delivered_total", "Match messages sent")
+metrics.counter("matches_not_delivered_total", "Match messages that couldn't be sent")
+
+santa_archive = SantaArchive(config.get('persistence', {}).get('archive_file', 'persistence/archive.sqlite'))
+
+admin_cache = AdminCache(maxsize=config.telegram.get('admins_cache_size', 4096))
+
+edit_coalescer = EditCoalescer(
+    updater.job_queue,
+    debounce=config.telegram.get('edit_debounce', 2.0),
+    max_latency=config.telegram.get('edit_max_latency', 10.0)
 )
 
-BOT_LINK = f"https://t.me/{updater.bot.username}"
+# expired santas are closed by the worker that processes the updates of their chat, so that a santa can't be closed
+# while someone is joining it
+expiry_scheduler = ExpiryScheduler(
+    on_expired=lambda context, chat_id: context.dispatcher.run_keyed(chat_id, close_secret_santa_if_expired, context, chat_id)
+)
+
+# the messages of the expired santas are edited on their own threads, so that a burst of expirations doesn't keep
+# the workers busy (the edits are paced by the outbound scheduler)
+expired_edits = ratelimit.BoundedExecutor(
+    workers=config.telegram.get('expired_edit_workers', 2),
+    bound=100,
+    thread_name_prefix="expired_edits"
+)
 
 
 class NewGroup(MessageFilter):
@@ -92,21 +192,42 @@ class NewGroup(MessageFilter):
                     return True
 
 
-def load_logging_config(file_name='logging.json'):
+LOGGING_PROFILES = {
+    "default": "logging.json",  # everything, DEBUG included
+    "production": "logging.production.json",  # INFO and above, the hottest lines sampled
+}
+
+
+def load_logging_config(file_name: Optional[str] = None):
+    if not file_name:
+        file_name = LOGGING_PROFILES[config.get('logging', {}).get('profile', 'default')]
+
     with open(file_name, 'r') as f:
         logging_config = json.load(f)
 
+    # not part of dictConfig's schema: {"queue": bool, "queue_size": int, "sampling": {"logger[:function]": N}}
+    pipeline = logging_config.pop('pipeline', {})
     logging.config.dictConfig(logging_config)
 
+    if pipeline.get('queue', False):
+        logpipeline.start_queue_listener(pipeline.get('queue_size', 10000), pipeline.get('sampling', None))
+    elif pipeline.get('sampling', None):
+        logpipeline.add_sampling(pipeline['sampling'])
+
 
-load_logging_config("logging.json")
+load_logging_config()
 
-logger = logging.getLogger(__name__)
+# not __name__: it's "__main__" when the bot is started with "python main.py", and the logging config refers to "main"
+logger = logging.getLogger("main")
+
+
+def bot_link(bot: Bot) -> str:
+    # not a constant: bot.username calls getMe the first time, and importing this module must not need the network
+    return f"https://t.me/{bot.username}"
 
 
-@MWT(timeout=60 * 60)
 def get_admin_ids(bot: Bot, chat_id: int):
-    return [admin.user.id for admin in bot.get_chat_administrators(chat_id)]
+    return admin_cache.get(bot, chat_id)
 
 
 def administrators(func):
@@ -163,10 +284,10 @@ def bot_restricted_check():
                 error_str = str(e).lower()
                 if Error.REMOVED_FROM_GROUP in error_str:
                     logger.info("تمت الإزالة من الدردشة %d: تنظيف البيانات", update.effective_chat.id)
-                    context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+                    pop_active_santa(context.chat_data, update.effective_chat.id)
                 elif Error.SEND_MESSAGE_DISABLED in error_str or Error.CANT_EDIT in error_str:
                     logger.info("لا يمكن إرسال الرسائل في الدردشة %d: يتم وضع علامة عليها كمكتومة", update.effective_chat.id)
-                    context.chat_data[MUTED_KEY] = True
+                    set_muted(context.chat_data, update.effective_chat.id)
                 else:
                     raise e
 
@@ -185,14 +306,14 @@ def fail_with_message(answer_to_message=True):
                 logger.error('حدث خطأ أثناء تنفيذ الرد: %s', error_str, exc_info=True)
 
                 error_str_message = f"حدث خطأ أثناء تنفيذ الرد <code>{func.__name__}()</code>: <code>{utilities.escape(error_str)}</code>"
+                # reported first: during an incident the reply below is likely to fail too
+                utilities.error_reporter.report(context.bot, (func.__name__, type(e).__name__, error_str), error_str_message)
+
                 if answer_to_message and update.message:
                     update.message.reply_html(error_str_message)
                 elif answer_to_message and update.callback_query:
                     update.effective_message.reply_html(error_str_message)
 
-                if config.telegram.log_chat:
-                    context.bot.send_message(config.telegram.log_chat, f"#{context.bot.username} {error_str_message}")
-
         return wrapped
     return real_decorator
 
@@ -207,12 +328,69 @@ def fail_with_message_job(func):
             logger.error('حدث خطأ أثناء تنفيذ المهمة: %s', error_str, exc_info=True)
 
             error_str_message = f"حدث خطأ أثناء تنفيذ مهمة <code>{func.__name__}()</code>: <code>{utilities.escape(error_str)}</code>"
-            if config.telegram.log_chat:
-                context.bot.send_message(config.telegram.log_chat, f"#{context.bot.username} {error_str_message}")
+            utilities.error_reporter.report(context.bot, (func.__name__, type(e).__name__, error_str), error_str_message)
 
     return wrapped
 
 
+def persist_chat_data(dispatcher: Dispatcher, chat_id: int):
+    # PTB only persists the chat_data of the chat an update comes from: we have to do it ourselves when a private
+    # chat update changes the data of a group (eg. joining through a deeplink)
+    if dispatcher.persistence and dispatcher.persistence.store_chat_data:
+        dispatcher.persistence.update_chat_data(chat_id, dispatcher.chat_data[chat_id])
+
+
+def persist_bot_data(dispatcher: Dispatcher):
+    # jobs don't persist anything by themselves: we have to do it when they change bot_data (eg. the matches delivery)
+    if dispatcher.persistence and dispatcher.persistence.store_bot_data:
+        dispatcher.persistence.update_bot_data(dispatcher.bot_data)
+
+
+def get_active_santa(chat_data: dict) -> Optional[SecretSanta]:
+    value = chat_data.get(ACTIVE_SECRET_SANTA_KEY, None)
+    if value is None or isinstance(value, SecretSanta):
+        return value
+
+    # saved as a dict by an older version: from now on it will be saved as a SecretSanta
+    santa = chat_data[ACTIVE_SECRET_SANTA_KEY] = SecretSanta.from_dict(value)
+    return santa
+
+
+def santa_deadline(santa: SecretSanta) -> datetime.datetime:
+    return santa.created_on + datetime.timedelta(days=config.santa.timeout)
+
+
+def save_active_santa(chat_data: dict, santa: SecretSanta):
+    chat_data[ACTIVE_SECRET_SANTA_KEY] = santa
+    chat_index.add_santa(santa.chat_id)
+    chat_index.set_participants(santa.chat_id, santa.get_participants_count())
+    expiry_scheduler.set(santa.chat_id, santa_deadline(santa))
+
+
+def pop_active_santa(chat_data: dict, chat_id: int) -> Optional[SecretSanta]:
+    chat_index.remove_santa(chat_id)
+    expiry_scheduler.remove(chat_id)
+    value = chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+    if value is None:
+        return
+
+    santa = SecretSanta.load(value)
+    # the santa message is going to be edited for the last time (or not at all): drop the pending edits
+    edit_coalescer.cancel((chat_id, santa.santa_message_id))
+
+    return santa
+
+
+def set_muted(chat_data: dict, chat_id: int):
+    chat_data[MUTED_KEY] = True
+    chat_index.add_muted(chat_id)
+
+
+def pop_muted(chat_data: dict, chat_id: int):
+    chat_index.remove_muted(chat_id)
+    chat_data.pop(MUTED_KEY, None)
+
+
 def get_secret_santa():
     def real_decorator(func):
         @wraps(func)
@@ -221,8 +399,7 @@ def get_secret_santa():
             santa = None
             if update.effective_chat.id < 0:
                 logger.debug("البحث عن سر سانتا نشط في بيانات الدردشة %d...", update.effective_chat.id)
-                if ACTIVE_SECRET_SANTA_KEY in context.chat_data:
-                    santa = SecretSanta.from_dict(context.chat_data[ACTIVE_SECRET_SANTA_KEY])
+                santa = get_active_santa(context.chat_data)
             else:
                 if update.callback_query:
                     santa_chat_id = int(context.matches[0].group(1))
@@ -233,33 +410,29 @@ def get_secret_santa():
                 santa = find_santa_by_chat_id(context.dispatcher.chat_data, santa_chat_id)
 
             result_santa = func(update, context, santa, *args, **kwargs)
-            if result_santa and isinstance(result_santa, SecretSanta):
+            # the santa we pass is the one stored in chat_data: it has to be saved again only if it's new or changed
+            if result_santa and isinstance(result_santa, SecretSanta) and result_santa.dirty:
                 logger.debug("حفظ كائن SecretSanta المُرجع للدردشة %d...", result_santa.chat_id)
-                context.chat_data[ACTIVE_SECRET_SANTA_KEY] = result_santa.dict()
+                save_active_santa(context.dispatcher.chat_data[result_santa.chat_id], result_santa)
+                if result_santa.chat_id != update.effective_chat.id:
+                    persist_chat_data(context.dispatcher, result_santa.chat_id)
 
         return wrapped
     return real_decorator
 
 
-def gen_participants_list(participants: dict, join_by: Optional[str] = None):
-    participants_list = []
-    i = 1
-    for participant_id, participant in participants.items():
-        string = f'<b>{i}</b>. {utilities.mention_escaped_by_id(participant_id, participant["name"])}'
-        participants_list.append(string)
-        i += 1
-
-    if isinstance(join_by, str):
-        return join_by.join(participants_list)
+def participants_text(santa: SecretSanta) -> str:
+    # the list of a large Secret Santa wouldn't fit in a message: only the count is shown
+    if santa.is_large():
+        return f"عدد المشاركين: <b>{santa.get_participants_count()}</b>"
 
-    return participants_list
+    return f"قائمة المشاركين:\n\n{santa.participants_html()}"
 
 
 def cancel_because_cant_send_messages(context: CallbackContext, santa: SecretSanta):
     text = "<i>تم إلغاء هذا السر سانتا لأنني لا أستطيع إرسال الرسائل في هذه المجموعة</i>"
     if santa.get_participants_count():
-        participants_list = gen_participants_list(santa.participants, join_by="\n")
-        text = f"{text}\nقائمة المشاركين:\n\n{participants_list}"
+        text = f"{text}\n{participants_text(santa)}"
 
     return context.bot.edit_message_text(
         chat_id=santa.chat_id,
@@ -279,34 +452,33 @@ def update_secret_santa_message(context: CallbackContext, santa: SecretSanta):
             participants_count=participants_count
         )
     elif santa.started:
-        participants_list = gen_participants_list(santa.participants)
-
         base_text = '{santa} لقد بدأ هذا السر سانتا وقد ' \
                     '<a href="{bot_link}">تلقى الجميع مطابقتهم</a>!\n' \
-                    'قائمة المشاركين:\n\n' \
                     '{participants}'
 
         text = base_text.format(
             santa=Emoji.SANTA,
-            bot_link=BOT_LINK,
-            participants="\n".join(participants_list),
+            bot_link=bot_link(context.bot),
+            participants=participants_text(santa),
             creator=santa.creator_name_escaped,
         )
         reply_markup = None
     else:
-        participants_list = gen_participants_list(santa.participants)
-
         min_participants_text = ""
         if santa.get_missing_count() > 0:
             min_participants_text = f". يحتاج {santa.get_missing_count()} شخص آخر لبدء هذا"
 
-        base_text = '{santa} أوه! سر سانتا جديد!\nقائمة المشاركين:\n\n{participants}\n\n' \
+        participants = participants_text(santa)
+        if santa.is_large():
+            participants = f'{participants}. استخدم زر "<b>المشاركون</b>" لتصفح القائمة'
+
+        base_text = '{santa} أوه! سر سانتا جديد!\n{participants}\n\n' \
                     'للانضمام، استخدم زر "<b>انضم</b>" أدناه ثم اضغط على "<b>ابدأ</b>".\n' \
                     'فقط {creator} يمكنه بدء هذا السر سانتا{min_participants}'
 
         text = base_text.format(
             santa=Emoji.SANTA,
-            participants="\n".join(participants_list),
+            participants=participants,
             creator=santa.creator_name_escaped,
             min_participants=min_participants_text
         )
@@ -317,6 +489,12 @@ def update_secret_santa_message(context: CallbackContext, santa: SecretSanta):
             participants_count=participants_count
         )
 
+    # a started santa's message is edited only once, there's no need to remember what we sent
+    edit_key = (santa.chat_id, santa.santa_message_id)
+    if not santa.started and edit_coalescer.is_unchanged(edit_key, text, reply_markup):
+        logger.debug("رسالة سر سانتا (%d, %d) لم تتغير: لا حاجة لتعديلها", santa.chat_id, santa.santa_message_id)
+        return
+
     try:
         edited_message = context.bot.edit_message_text(
             chat_id=santa.chat_id,
@@ -326,12 +504,38 @@ def update_secret_santa_message(context: CallbackContext, santa: SecretSanta):
             parse_mode=ParseMode.HTML
         )
     except (BadRequest, TelegramError) as e:
+        if Error.MESSAGE_NOT_MODIFIED in str(e).lower() and not santa.started:
+            edit_coalescer.sent(edit_key, text, reply_markup)
         logger.error("استثناء أثناء تعديل رسالة سر سانتا (%d, %d): %s", santa.chat_id, santa.santa_message_id, str(e))
         return
 
+    if not santa.started:
+        edit_coalescer.sent(edit_key, text, reply_markup)
+
     return edited_message
 
 
+def schedule_secret_santa_message_update(santa: SecretSanta):
+    # joins, leaves and name updates don't edit the santa message right away: bursts of changes are collapsed
+    # into a single edit that renders the santa as it is when the edit is actually sent
+    chat_id = santa.chat_id
+    santa_message_id = santa.santa_message_id
+
+    def update_if_still_active(context: CallbackContext):
+        if chat_index.is_muted(chat_id):
+            logger.debug("تعديل مؤجل لرسالة سر سانتا في %d: البوت مكتوم", chat_id)
+            return
+
+        current_santa = find_santa_by_chat_id(context.dispatcher.chat_data, chat_id)
+        if not current_santa or current_santa.santa_message_id != santa_message_id:
+            logger.debug("تعديل مؤجل لرسالة سر سانتا (%d, %d): لم يعد نشطًا", chat_id, santa_message_id)
+            return
+
+        update_secret_santa_message(context, current_santa)
+
+    edit_coalescer.schedule((chat_id, santa_message_id), update_if_still_active)
+
+
 def create_new_secret_santa(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
     if santa:
         text_message_exists = f"👆 هناك بالفعل <a href=\"{santa.link()}\">سر سانتا نشط</a> في " \
@@ -373,11 +577,13 @@ def create_new_secret_santa(update: Update, context: CallbackContext, santa: Opt
         santa_message_id = sent_message.message_id
 
     new_secret_santa.santa_message_id = santa_message_id
+    metrics.inc("santas_created_total")
 
     return new_secret_santa
 
 
 @fail_with_message()
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_new_secret_santa_command(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -391,6 +597,7 @@ def on_new_secret_santa_command(update: Update, context: CallbackContext, santa:
 
 
 @fail_with_message()
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_new_secret_santa_button(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -399,33 +606,28 @@ def on_new_secret_santa_button(update: Update, context: CallbackContext, santa:
     return create_new_secret_santa(update, context, santa)
 
 
-def find_key(dispatcher_user_data: dict, target_chat_id: int, key_to_find: Union[int, str]) -> bool:
-    for chat_data_chat_id, chat_data in dispatcher_user_data.items():
-        if chat_data_chat_id != target_chat_id:
-            continue
-
-        return key_to_find in chat_data
-
-
 def find_santa_by_chat_id(dispatcher_chat_data: dict, santa_chat_id: int):
-    for chat_data_chat_id, chat_data in dispatcher_chat_data.items():
-        if chat_data_chat_id != santa_chat_id:
-            continue
+    if not chat_index.has_santa(santa_chat_id):
+        logger.debug("لا يوجد سر سانتا نشط في الدردشة %d", santa_chat_id)
+        return
 
-        if ACTIVE_SECRET_SANTA_KEY not in chat_data:
-            logger.debug("بيانات الدردشة للدردشة %d موجودة، لكن لا يوجد سر سانتا نشط", santa_chat_id)
-            return
+    # .get() so we don't create an empty entry in the chat_data defaultdict
+    santa = get_active_santa(dispatcher_chat_data.get(santa_chat_id, {}))
+    if not santa:
+        logger.warning("الدردشة %d مفهرسة بسر سانتا نشط، لكن بيانات الدردشة لا تحتوي عليه", santa_chat_id)
+        chat_index.remove_santa(santa_chat_id)
+        return
 
-        santa_dict = chat_data[ACTIVE_SECRET_SANTA_KEY]
-        return SecretSanta.from_dict(santa_dict)
+    return santa
 
 
 @fail_with_message()
+@timed(handler_latency)
 def on_join_deeplink(update: Update, context: CallbackContext):
     santa_chat_id = int(context.matches[0].group(1))
     logger.info("رابط انضمام من %d، معرّف الدردشة: %d", update.effective_user.id, santa_chat_id)
 
-    if find_key(context.dispatcher.chat_data, santa_chat_id, MUTED_KEY):
+    if chat_index.is_muted(santa_chat_id):
         update.message.reply_html(f"يبدو أنني لا أستطيع إرسال رسائل في تلك المجموعة. لا أستطيع السماح "
                                   f"للمشاركين الجدد بالانضمام حتى أستطيع إرسال رسائل هناك، عذراً {Emoji.SAD}")
         return
@@ -451,8 +653,7 @@ def on_join_deeplink(update: Update, context: CallbackContext):
 
     duplicate_name = santa.is_duplicate_name(update.effective_user.first_name)
     santa.add(update.effective_user)
-
-    context.dispatcher.chat_data[santa_chat_id][ACTIVE_SECRET_SANTA_KEY] = santa.dict()
+    metrics.inc("joins_total")
 
     if santa.creator_id == update.effective_user.id:
         wait_for_start_text = f"\nيمكنك بدؤه في أي وقت باستخدام زر \"<b>ابدأ المطابقة</b>\" في المجموعة، " \
@@ -473,11 +674,14 @@ def on_join_deeplink(update: Update, context: CallbackContext):
                                 f"زر \"تحديث اسمك\" أعلاه لتجنب الارتباك {Emoji.SNOWMAN_2}", quote=True)
 
     santa.set_user_join_message_id(update.effective_user, sent_message.message_id)
+    save_active_santa(context.dispatcher.chat_data[santa_chat_id], santa)
+    persist_chat_data(context.dispatcher, santa_chat_id)
 
-    update_secret_santa_message(context, santa)
+    schedule_secret_santa_message_update(santa)
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_leave_button_group(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -490,7 +694,8 @@ def on_leave_button_group(update: Update, context: CallbackContext, santa: Optio
     last_join_message_id = santa.get_user_join_message_id(update.effective_user)
 
     santa.remove(update.effective_user)
-    update_secret_santa_message(context, santa)
+    metrics.inc("leaves_total")
+    schedule_secret_santa_message_update(santa)
 
     update.callback_query.answer(f"لقد تمت إزالتك من هذا السر سانتا")
 
@@ -500,18 +705,93 @@ def on_leave_button_group(update: Update, context: CallbackContext, santa: Optio
     return santa
 
 
-def save_recently_started_santa(bot_data: dict, santa: SecretSanta):
+def participants_page_message(santa: SecretSanta, page: int):
+    page_html, page, pages_count = santa.participants_page(page, config.santa.get('page_size', 30))
+    text = f"{Emoji.LIST} المشاركون في {santa.chat_title_escaped}'s {santa.inline_link('سر سانتا')} " \
+           f"(الصفحة {page + 1}/{pages_count}):\n\n{page_html}"
+
+    return text, keyboards.participants_page(santa.chat_id, page, pages_count)
+
+
+@fail_with_message(answer_to_message=False)
+@timed(handler_latency)
+@bot_restricted_check()
+@get_secret_santa()
+def on_participants_button(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
+    logger.debug("زر المشاركين في المجموعة: %d -> %d", update.effective_user.id, update.effective_chat.id)
+
+    if not santa:
+        update.callback_query.answer(f"لم يعد هذا السر سانتا نشطًا", show_alert=True)
+        return
+
+    # the list is sent in the private chat: browsing it doesn't edit the group message
+    text, reply_markup = participants_page_message(santa, 0)
+    try:
+        context.bot.send_message(update.effective_user.id, text, reply_markup=reply_markup)
+    except (TelegramError, BadRequest) as e:
+        logger.debug("لا يمكن إرسال قائمة المشاركين إلى %d: %s", update.effective_user.id, str(e))
+        update.callback_query.answer(f"لا أستطيع مراسلتك: ابدأ محادثة خاصة معي أولاً", show_alert=True)
+        return
+
+    update.callback_query.answer(f"{Emoji.LIST} أرسلت لك قائمة المشاركين في الخاص")
+
+
+def previous_pairs(bot_data: dict, chat_id: int) -> drafting.Exclusions:
+    """The (santa, receiver) pairs of the Secret Santas recently started in a chat"""
+
+    santas = santa_archive.chat_santas(chat_id, since=utilities.now() - datetime.timedelta(seconds=Time.WEEK_2))
+    santas.extend(bot_data.get(DELIVERING_SANTAS_KEY, {}).get(chat_id, {}).values())
+
+    pairs = []
+    for santa in santas:
+        pairs.extend(santa.matched_pairs())
+
+    return drafting.exclusions_from_pairs(pairs)
+
+
+@timed(handler_latency)
+def draft_matches(bot_data: dict, santa: SecretSanta) -> List[tuple]:
+    """Draft the matches avoiding, if possible, the pairs of the previous Secret Santas of the chat. Raises
+    DraftInfeasible only if there's no valid assignment at all"""
+
+    participants = list(santa.participants)
+    exclusions = previous_pairs(bot_data, santa.chat_id)
+    if exclusions:
+        try:
+            return drafting.draft(participants, exclusions)
+        except drafting.DraftInfeasible as e:
+            logger.info("لا يمكن تجنب تكرار أزواج سر سانتا السابق في الدردشة %d: %s", santa.chat_id, str(e))
+
+    return drafting.draft(participants)
+
+
+def save_delivering_santa(bot_data: dict, santa: SecretSanta):
     chat_id = santa.chat_id
 
-    if RECENTLY_STARTED_SANTAS_KEY not in bot_data:
-        bot_data[RECENTLY_STARTED_SANTAS_KEY] = {}
-    if chat_id not in bot_data[RECENTLY_STARTED_SANTAS_KEY]:
-        bot_data[RECENTLY_STARTED_SANTAS_KEY][chat_id] = {}
+    # setdefault(): bot_data is shared by the updates of all the chats, which might be processed concurrently
+    chat_santas = bot_data.setdefault(DELIVERING_SANTAS_KEY, {}).setdefault(chat_id, {})
+    chat_santas[santa.santa_message_id] = santa
+
 
-    bot_data[RECENTLY_STARTED_SANTAS_KEY][chat_id][santa.santa_message_id] = santa.dict()
+def find_delivering_santa(bot_data: dict, chat_id: int, santa_message_id: int) -> Optional[SecretSanta]:
+    return bot_data.get(DELIVERING_SANTAS_KEY, {}).get(chat_id, {}).get(santa_message_id, None)
+
+
+def archive_delivered_santa(dispatcher: Dispatcher, santa: SecretSanta):
+    # archived first: if we stop in between, the santa is archived again (replacing itself) on the next run
+    santa_archive.add(santa)
+
+    delivering_santas = dispatcher.bot_data.get(DELIVERING_SANTAS_KEY, {})
+    chat_santas = delivering_santas.get(santa.chat_id, {})
+    chat_santas.pop(santa.santa_message_id, None)
+    if not chat_santas:
+        delivering_santas.pop(santa.chat_id, None)
+
+    persist_bot_data(dispatcher)
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_match_button(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -528,17 +808,26 @@ def on_match_button(update: Update, context: CallbackContext, santa: Optional[Se
 
     sent_message = update.effective_message.reply_html(f'{Emoji.HOURGLASS} <i>جاري مطابقة المستخدمين...</i>')
 
+    def send_chat_action(user_id: int):
+        return context.bot.send_chat_action(user_id, ChatAction.TYPING)
+
+    # checking thousands of participants would take as long as sending their matches: the matches that can't be
+    # delivered to a large Secret Santa are reported at the end instead
     blocked_by = []
-    for user_id, user_data in santa.participants.items():
-        try:
-            context.bot.send_chat_action(user_id, ChatAction.TYPING)
-        except (TelegramError, BadRequest) as e:
-            if Error.USER_BLOCKED_BOT in str(e).lower():
+    if not santa.is_large():
+        results = ratelimit.fan_out(send_chat_action, list(santa.participants), config.telegram.get('fan_out_workers', 8))
+        for user_id, _, error in results:
+            if not error:
+                continue
+
+            if not isinstance(error, TelegramError):
+                raise error
+            elif Error.USER_BLOCKED_BOT in str(error).lower():
                 logger.debug("%d حظر البوت", user_id)
             else:
-                logger.warning("لا يمكن إرسال إجراء الدردشة إلى %d: %s", user_id, str(e))
+                logger.warning("لا يمكن إرسال إجراء الدردشة إلى %d: %s", user_id, str(error))
 
-            blocked_by.append(utilities.mention_escaped_by_id(user_id, user_data["name"]))
+            blocked_by.append(santa.user_mention_escaped(user_id))
 
     if blocked_by:
         users_list = ", ".join(blocked_by)
@@ -547,19 +836,10 @@ def on_match_button(update: Update, context: CallbackContext, santa: Optional[Se
         sent_message.edit_text(text)
         return
 
-    matches = []
-    max_attempts = 12
-    failed_attempts = 0
-    while failed_attempts < max_attempts:
-        try:
-            matches = utilities.draft(list(santa.participants.keys()))
-            break
-        except (utilities.TooManyInvalidPicks, utilities.StuckOnLastItem) as e:
-            failed_attempts += 1
-            logger.warning("خطأ في إعداد الأزواج: %s (محاولة فاشلة %d/%d)", str(e), failed_attempts, max_attempts)
-
-    if not matches:
-        logger.error("قائمة المطابقات لا تزال فارغة (محاولات فاشلة: %d/%d)", failed_attempts, max_attempts)
+    try:
+        matches = draft_matches(context.bot_data, santa)
+    except drafting.DraftInfeasible as e:
+        logger.error("لا يمكن إعداد الأزواج في الدردشة %d: %s", update.effective_chat.id, str(e))
 
         utilities.log_tg(context.bot, f"#drafting_error أثناء إنشاء الأزواج للدردشة {update.effective_chat.id}")
 
@@ -568,31 +848,141 @@ def on_match_button(update: Update, context: CallbackContext, santa: Optional[Se
         sent_message.edit_text(text)
         return
 
-    logger.debug("تم جمع أزواج المطابقات، محاولات فاشلة: %d", failed_attempts)
+    for santa_id, receiver_id in matches:
+        santa.set_user_receiver(santa_id, receiver_id)
+
+    santa.start()
+    metrics.inc("santas_started_total")
+    started_today.inc()
+
+    # the santa is moved to bot_data before its matches are sent: deliver_matches() sends them a chunk at a time,
+    # and the ones not sent yet are the participants with a receiver but no match message. Once they're all sent,
+    # the santa is moved to the archive
+    logger.debug("إزالة سر سانتا النشط من بيانات الدردشة وحفظ نسخة في بيانات البوت...")
+    pop_active_santa(context.chat_data, santa.chat_id)
+
+    save_delivering_santa(context.bot_data, santa)
+
+    schedule_matches_delivery(context.job_queue, santa, sent_message.message_id)
+
+
+def schedule_matches_delivery(job_queue: JobQueue, santa: SecretSanta, progress_message_id: Optional[int] = None):
+    job_queue.run_once(deliver_matches, 0, context=(santa.chat_id, santa.santa_message_id, progress_message_id))
 
-    for santa_id, present_receiver_id in matches:
-        present_receiver_name = santa.get_user_name(present_receiver_id)
-        present_receiver_mention = utilities.mention_escaped_by_id(present_receiver_id, present_receiver_name)
 
-        text = f"{Emoji.SANTA}{Emoji.PRESENT} أنت <a href=\"{santa.link()}\">سر سانتا</a> لـ {present_receiver_mention}!"
+@timed(handler_latency)
+def send_matches_chunk(context: CallbackContext, santa: SecretSanta, pairs: List[tuple]):
+    santa_link = santa.link()
+
+    def send_match(match: tuple):
+        santa_id, present_receiver_id = match
+        present_receiver_mention = santa.user_mention_escaped(present_receiver_id)
+
+        text = f"{Emoji.SANTA}{Emoji.PRESENT} أنت <a href=\"{santa_link}\">سر سانتا</a> لـ {present_receiver_mention}!"
+
+        return context.bot.send_message(santa_id, text)
+
+    results = ratelimit.fan_out(send_match, pairs, config.telegram.get('fan_out_workers', 8))
+    for (santa_id, _), match_message, error in results:
+        if error:
+            logger.error("لا يمكن إرسال المطابقة إلى %d: %s", santa_id, str(error))
+            santa.set_user_match_message_id(santa_id, NOT_DELIVERED)
+            metrics.inc("matches_not_delivered_total")
+            continue
 
-        match_message = context.bot.send_message(santa_id, text)
         santa.set_user_match_message_id(santa_id, match_message.message_id)
+        metrics.inc("matches_delivered_total")
 
-    santa.start()
 
-    logger.debug("إزالة سر سانتا النشط من بيانات الدردشة وحفظ نسخة في بيانات البوت...")
-    context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+def edit_delivery_message(context: CallbackContext, santa: SecretSanta, progress_message_id: Optional[int], text: str):
+    try:
+        if progress_message_id:
+            context.bot.edit_message_text(text, chat_id=santa.chat_id, message_id=progress_message_id)
+        else:
+            # the delivery was resumed after a restart: the progress message is not known
+            context.bot.send_message(santa.chat_id, text, reply_to_message_id=santa.santa_message_id, allow_sending_without_reply=True)
+    except (TelegramError, BadRequest) as e:
+        logger.warning("لا يمكن تحديث رسالة إرسال المطابقات في الدردشة %d: %s", santa.chat_id, str(e))
 
-    save_recently_started_santa(context.bot_data, santa)
 
-    text = f"لقد تلقى الجميع مطابقتهم في <a href=\"{BOT_LINK}\">الدردشات الخاصة بهم</a>!"
-    sent_message.edit_text(text)
+@fail_with_message_job
+@timed(handler_latency)
+def deliver_matches(context: CallbackContext):
+    """Send the next chunk of matches of a started Secret Santa, then schedule itself again. bot_data is persisted
+    after every chunk, so after a restart resume_matches_delivery() continues from the first match not sent"""
+
+    chat_id, santa_message_id, progress_message_id = context.job.context
+    santa = find_delivering_santa(context.bot_data, chat_id, santa_message_id)
+    if not santa:
+        logger.warning("سر سانتا (%d, %d) لم يعد موجودًا: لا يمكن إرسال مطابقاته", chat_id, santa_message_id)
+        return
+
+    pairs = santa.pending_deliveries(config.santa.get('delivery_chunk_size', 100))
+    if pairs:
+        send_matches_chunk(context, santa, pairs)
+        persist_bot_data(context.dispatcher)
+
+        done, total = santa.delivery_progress()
+        logger.debug("تم إرسال %d/%d مطابقة في الدردشة %d", done, total, chat_id)
+        if done < total:
+            text = f"{Emoji.HOURGLASS} <i>جاري إرسال المطابقات... ({done}/{total})</i>"
+            edit_delivery_message(context, santa, progress_message_id, text)
+            context.job_queue.run_once(deliver_matches, 0, context=context.job.context)
+            return
+
+    not_delivered = santa.undelivered()
+    text = f"لقد تلقى الجميع مطابقتهم في <a href=\"{bot_link(context.bot)}\">الدردشات الخاصة بهم</a>!"
+    if not_delivered:
+        utilities.log_tg(context.bot, f"#delivery_error لم يتم إرسال {len(not_delivered)} مطابقة في الدردشة {chat_id}")
+
+        max_mentions = config.santa.get('large_threshold', 30)
+        mentions = ", ".join(santa.user_mention_escaped(user_id) for user_id in not_delivered[:max_mentions])
+        if len(not_delivered) > max_mentions:
+            mentions = f"{mentions} (+{len(not_delivered) - max_mentions})"
+
+        text = f"{Emoji.WARN} تم إرسال المطابقات، لكنني لم أتمكن من إرسال مطابقة {mentions}"
+
+    edit_delivery_message(context, santa, progress_message_id, text)
 
     update_secret_santa_message(context, santa)
 
+    archive_delivered_santa(context.dispatcher, santa)
+
+
+def resume_matches_delivery(dispatcher: Dispatcher) -> int:
+    """Schedule the delivery of the Secret Santas whose matches were being sent when the bot stopped"""
+
+    resumed = 0
+    for chat_santas in list(dispatcher.bot_data.get(DELIVERING_SANTAS_KEY, {}).values()):
+        for santa in list(chat_santas.values()):
+            logger.info("استئناف إرسال مطابقات سر سانتا (%d, %d)", santa.chat_id, santa.santa_message_id)
+            schedule_matches_delivery(dispatcher.job_queue, santa)
+            resumed += 1
+
+    return resumed
+
+
+def migrate_recently_started_santas(dispatcher: Dispatcher):
+    """Older versions kept every started santa in bot_data: move them to the archive"""
+
+    recently_started_santas = dispatcher.bot_data.pop(RECENTLY_STARTED_SANTAS_KEY, None)
+    if not recently_started_santas:
+        return
+
+    santas = []
+    for chat_santas in recently_started_santas.values():
+        for santa_value in chat_santas.values():
+            santa = SecretSanta.load(santa_value)
+            if santa.pending_deliveries(1):
+                save_delivering_santa(dispatcher.bot_data, santa)
+            else:
+                santas.append(santa)
+
+    logger.info("نقل %d سر سانتا بدأت مؤخرًا من بيانات البوت إلى الأرشيف", santa_archive.add_many(santas))
+
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_cancel_button(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -613,13 +1003,15 @@ def on_cancel_button(update: Update, context: CallbackContext, santa: Optional[S
         )
         return
 
-    context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+    pop_active_santa(context.chat_data, santa.chat_id)
+    metrics.inc("santas_cancelled_total")
 
     text = "<i>تم إلغاء هذا السر سانتا بواسطة منشئه</i>"
     update.callback_query.edit_message_text(text, reply_markup=None)
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_revoke_button(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -640,6 +1032,7 @@ def on_revoke_button(update: Update, context: CallbackContext, santa: Optional[S
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 def on_hide_commands_command(update: Update, context: CallbackContext):
     logger.debug("/hidecommands command: %d -> %d", update.effective_user.id, update.effective_chat.id)
@@ -654,6 +1047,7 @@ def on_hide_commands_command(update: Update, context: CallbackContext):
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 def on_show_commands_command(update: Update, context: CallbackContext):
     logger.debug("/showcommands command: %d -> %d", update.effective_user.id, update.effective_chat.id)
@@ -666,6 +1060,7 @@ def on_show_commands_command(update: Update, context: CallbackContext):
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 @bot_restricted_check()
 @get_secret_santa()
 def on_cancel_command(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
@@ -680,7 +1075,8 @@ def on_cancel_command(update: Update, context: CallbackContext, santa: Optional[
         logger.debug("المستخدم ليس مسؤولًا ولا منشئ السر سانتا")
         return
 
-    context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+    pop_active_santa(context.chat_data, santa.chat_id)
+    metrics.inc("santas_cancelled_total")
 
     try:
         context.bot.edit_message_text(
@@ -728,6 +1124,7 @@ def private_chat_button():
 
 
 @fail_with_message(answer_to_message=True)
+@timed(handler_latency)
 @get_secret_santa()
 @private_chat_button()
 def on_update_name_button_private(update: Update, context: CallbackContext, santa: SecretSanta):
@@ -744,39 +1141,53 @@ def on_update_name_button_private(update: Update, context: CallbackContext, sant
                                  f"(مفيد إذا كان هناك مشاركون يحملون أسماء مشابهة)", show_alert=True)
 
     if name_updated:
-        try:
-            update_secret_santa_message(context, santa)
-        except (TelegramError, BadRequest) as e:
-            if Error.MESSAGE_NOT_MODIFIED not in e.message:
-                raise e
-            logger.warning("زر تحديث الاسم في الدردشة الخاصة: لم يتم تعديل رسالة سانتا السر بعد الاستخدام")
+        schedule_secret_santa_message_update(santa)
 
         return santa
 
 
 @fail_with_message(answer_to_message=True)
+@timed(handler_latency)
 @get_secret_santa()
 @private_chat_button()
 def on_leave_button_private(update: Update, context: CallbackContext, santa: SecretSanta):
     logger.debug("زر مغادرة في الدردشة الخاصة: %d (معرّف دردشة سانتا: %d)", update.effective_user.id, santa.chat_id)
 
     santa.remove(update.effective_user)
+    metrics.inc("leaves_total")
 
     text = f"{Emoji.FREEZE} لقد تمت إزالتك من {santa.chat_title_escaped}'s " \
            f"<a href=\"{santa.link()}\">سر سانتا</a>"
     update.callback_query.edit_message_text(text, reply_markup=None)
 
+    schedule_secret_santa_message_update(santa)
+
+    return santa
+
+
+@fail_with_message(answer_to_message=True)
+@timed(handler_latency)
+@get_secret_santa()
+def on_participants_page_button_private(update: Update, context: CallbackContext, santa: Optional[SecretSanta] = None):
+    logger.debug("زر صفحة المشاركين في الدردشة الخاصة: %d", update.effective_user.id)
+
+    if not santa:
+        update.callback_query.answer(f"سر سانتا هذه الدردشة لم يعد صالحاً", show_alert=True)
+        update.callback_query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    text, reply_markup = participants_page_message(santa, int(context.matches[0].group(2)))
     try:
-        update_secret_santa_message(context, santa)
-    except (TelegramError, BadRequest) as e:
-        if Error.MESSAGE_NOT_MODIFIED not in e.message:
+        update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if Error.MESSAGE_NOT_MODIFIED not in str(e).lower():
             raise e
-        logger.warning("زر مغادرة في الدردشة الخاصة: لم يتم تعديل رسالة سانتا السر بعد الاستخدام")
 
-    return santa
+    update.callback_query.answer()
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 def on_supergroup_migration(update: Update, context: CallbackContext):
     if not update.message.migrate_to_chat_id:
         return
@@ -791,8 +1202,7 @@ def on_supergroup_migration(update: Update, context: CallbackContext):
 
     logger.debug("معرّف الدردشة القديم %d لديه سر سانتا جارٍ", old_chat_id)
 
-    santa_dict = context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY)
-    old_santa = SecretSanta.from_dict(santa_dict)
+    old_santa = pop_active_santa(context.chat_data, old_chat_id)
 
     new_secret_santa = SecretSanta(
         origin_message_id=update.effective_message.message_id,
@@ -809,13 +1219,15 @@ def on_supergroup_migration(update: Update, context: CallbackContext):
     new_secret_santa.santa_message_id = sent_message.message_id
 
     logger.debug("حفظ بيانات دردشة جديدة للمجموعة السوبرغروب %d...", new_chat_id)
-    context.dispatcher.chat_data[new_chat_id] = {ACTIVE_SECRET_SANTA_KEY: new_secret_santa.dict()}
+    context.dispatcher.chat_data[new_chat_id] = {}
+    save_active_santa(context.dispatcher.chat_data[new_chat_id], new_secret_santa)
 
     logger.debug("تحديث الرسالة الجديدة...")
     update_secret_santa_message(context, new_secret_santa)
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 def on_new_group_chat(update: Update, context: CallbackContext):
     logger.info("دردشة مجموعة جديدة: %d", update.effective_chat.id)
 
@@ -846,6 +1258,7 @@ def on_new_group_chat(update: Update, context: CallbackContext):
 
 
 @fail_with_message()
+@timed(handler_latency)
 def on_help(update: Update, _):
     logger.info("/start أو /help من: %s (النص: %s)", update.effective_user.id, update.message.text)
 
@@ -859,30 +1272,38 @@ def on_help(update: Update, _):
 
 
 @fail_with_message()
+@timed(handler_latency)
 @superadmin
 def admin_ongoing_command(update: Update, context: CallbackContext):
     logger.info("/ongoing from %d", update.effective_user.id)
 
-    santa_count = 0
-    participants_count = 0
-    for chat_data_chat_id, chat_data in context.dispatcher.chat_data.items():
-        if ACTIVE_SECRET_SANTA_KEY not in chat_data:
-            continue
+    text = f"• أسر سانتا الجارية: {metrics.value('active_santas')} ({metrics.value('participants')} مشارك)\n" \
+           f"• أسر سانتا التي بدأت اليوم: {metrics.value('started_today')}\n" \
+           f"• المطابقات المرسلة: {metrics.value('matches_delivered_total')} " \
+           f"(لم تُرسل: {metrics.value('matches_not_delivered_total')})\n" \
+           f"• المجموعات المكتومة: {metrics.value('muted_chats')}"
+
+    update.message.reply_html(text)
 
-        santa_count += 1
-        santa = SecretSanta.from_dict(chat_data[ACTIVE_SECRET_SANTA_KEY])
-        participants_count += santa.get_participants_count()
 
-    text = f"• أسر سانتا الجارية: {santa_count} ({participants_count} مشارك)"
+def latency_table(recorder: LatencyRecorder, limit: int = 15) -> str:
+    header = f"{'':<28} {'n':>6} {'err':>4} " + " ".join(f"{'p' + str(p):>6}" for p in PERCENTILES) + f" {'max':>6}"
+    rows = [header]
+    for name, count, errors, percentiles, max_seconds in recorder.report()[:limit]:
+        values = " ".join(f"{seconds * 1000:>4.0f}ms" for seconds in percentiles + [max_seconds])
+        rows.append(f"{name[:28]:<28} {count:>6} {errors:>4} {values}")
 
-    if RECENTLY_STARTED_SANTAS_KEY in context.bot_data:
-        recently_started_chats_count = len(context.bot_data[RECENTLY_STARTED_SANTAS_KEY])
-        recently_started_santas_count = 0
-        for _, santas_data in context.bot_data[RECENTLY_STARTED_SANTAS_KEY].items():
-            recently_started_santas_count += len(santas_data)
+    return utilities.html_escape("\n".join(rows))
 
-        text = f"{text}\n• أسر سانتا التي بدأت مؤخرًا: {recently_started_santas_count} في " \
-               f"{recently_started_chats_count} مجموعة"
+
+@fail_with_message()
+@timed(handler_latency)
+@superadmin
+def admin_perf_command(update: Update, context: CallbackContext):
+    logger.info("/perf from %d", update.effective_user.id)
+
+    text = f"<b>المعالجات</b>\n<pre>{latency_table(handler_latency)}</pre>\n\n" \
+           f"<b>استدعاءات Bot API</b>\n<pre>{latency_table(api_latency)}</pre>"
 
     update.message.reply_html(text)
 
@@ -911,6 +1332,16 @@ def was_unmuted(chat_member_update: ChatMemberUpdated):
 
 
 @fail_with_message(answer_to_message=False)
+@timed(handler_latency)
+def on_chat_member_update(update: Update, _):
+    chat_member = update.chat_member
+    logger.debug("تحديث عضو %d في الدردشة %d: %s", chat_member.new_chat_member.user.id, chat_member.chat.id, chat_member.new_chat_member.status)
+
+    admin_cache.on_member_status(chat_member.chat.id, chat_member.new_chat_member.user.id, chat_member.new_chat_member.status)
+
+
+@fail_with_message(answer_to_message=False)
+@timed(handler_latency)
 def on_my_chat_member_update(update: Update, context: CallbackContext):
     logger.debug("تحديث العضو في الدردشة %d", update.my_chat_member.chat.id)
     my_chat_member = update.my_chat_member
@@ -927,26 +1358,26 @@ def on_my_chat_member_update(update: Update, context: CallbackContext):
 
         return
 
+    admin_cache.on_member_status(my_chat_member.chat.id, my_chat_member.new_chat_member.user.id, my_chat_member.new_chat_member.status)
+
     if my_chat_member.new_chat_member.status == ChatMember.LEFT:
         logger.debug("old_chat_member: %s", my_chat_member.old_chat_member)
         logger.debug("new_chat_member: %s", my_chat_member.new_chat_member)
         logger.info("تمت إزالة البوت من %d، يتم إزالة بيانات الدردشة...", my_chat_member.chat.id)
-        context.chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
-        context.chat_data.pop(MUTED_KEY, None)
+        pop_active_santa(context.chat_data, my_chat_member.chat.id)
+        pop_muted(context.chat_data, my_chat_member.chat.id)
 
         now = utilities.now()
 
         context.chat_data[REMOVED_KEY] = now
 
-        if RECENTLY_LEFT_KEY not in context.bot_data:
-            context.bot_data[RECENTLY_LEFT_KEY] = {}
-        context.bot_data[RECENTLY_LEFT_KEY][my_chat_member.chat.id] = now
+        context.bot_data.setdefault(RECENTLY_LEFT_KEY, {})[my_chat_member.chat.id] = now
     elif was_muted(my_chat_member):
         logger.debug("تم كتم البوت في %d", my_chat_member.chat.id)
-        context.chat_data[MUTED_KEY] = True
+        set_muted(context.chat_data, my_chat_member.chat.id)
     elif was_unmuted(my_chat_member):
         logger.debug("تم إلغاء كتم البوت في %d", my_chat_member.chat.id)
-        context.chat_data.pop(MUTED_KEY, None)
+        pop_muted(context.chat_data, my_chat_member.chat.id)
     else:
         logger.debug("لا تغيير ذي صلة حدث (دردشة جماعية): %s", my_chat_member)
 
@@ -955,10 +1386,9 @@ def secret_santa_expired(context: CallbackContext, santa: SecretSanta):
     if not santa.started:
         text = f"<i>انتهت صلاحية هذا السر سانتا ({config.santa.timeout} يوم قد مضى منذ إنشائه)</i>"
     else:
-        participants_list = gen_participants_list(santa.participants)
-        text = '{hourglass} تم إغلاق هذا السر سانتا. قائمة المشاركين:\n\n{participants}'.format(
+        text = '{hourglass} تم إغلاق هذا السر سانتا. {participants}'.format(
             hourglass=Emoji.HOURGLASS,
-            participants="\n".join(participants_list)
+            participants=participants_text(santa)
         )
 
     try:
@@ -975,33 +1405,48 @@ def secret_santa_expired(context: CallbackContext, santa: SecretSanta):
     return edited_message
 
 
-@fail_with_message_job
-def close_old_secret_santas(context: CallbackContext):
-    logger.info("وظيفة تنظيف سر سانتا الغير نشط...")
+def close_secret_santa_if_expired(context: CallbackContext, chat_id: int):
+    chat_data = context.dispatcher.chat_data.get(chat_id, {})
+    santa = get_active_santa(chat_data)
+    if not santa:
+        expiry_scheduler.remove(chat_id)
+        return
 
-    for chat_id, chat_data in context.dispatcher.chat_data.items():
-        if ACTIVE_SECRET_SANTA_KEY not in chat_data:
-            continue
+    now = utilities.now()
+    diff_seconds = (now - santa.created_on).total_seconds()
+    if diff_seconds <= config.santa.timeout * Time.DAY_1:
+        # the deadline was computed with a shorter timeout: its heap entry is gone, schedule it again
+        logger.debug("سر سانتا في الدردشة %d لم تنتهِ صلاحيته بعد", chat_id)
+        expiry_scheduler.remove(chat_id)
+        expiry_scheduler.set(chat_id, santa_deadline(santa))
+        return
 
-        santa = SecretSanta.from_dict(chat_data[ACTIVE_SECRET_SANTA_KEY])
+    logger.debug("إزالة سر سانتا من الدردشة %d", chat_id)
+    pop_active_santa(chat_data, chat_id)
+    persist_chat_data(context.dispatcher, chat_id)
+    metrics.inc("santas_expired_total")
 
-        now = utilities.now()
-        diff_seconds = (now - santa.created_on).total_seconds()
-        if diff_seconds <= config.santa.timeout * Time.DAY_1:
-            continue
+    if MUTED_KEY in chat_data:
+        logger.info("لا يمكن تعديل رسالة سانتا المنتهية في الدردشة %d: البوت موضح كمكتوم", chat_id)
+    else:
+        expired_edits.submit(secret_santa_expired, context, santa)
 
-        if MUTED_KEY in chat_data:
-            logger.info("لا يمكن تعديل رسالة سانتا المنتهية في الدردشة %d: البوت موضح كمكتوم", chat_id)
-        else:
-            secret_santa_expired(context, santa)
 
-        logger.debug("إزالة سر سانتا من الدردشة %d", chat_id)
-        chat_data.pop(ACTIVE_SECRET_SANTA_KEY, None)
+def load_expiry_deadlines(dispatcher: Dispatcher):
+    if EXPIRY_DEADLINES_KEY not in dispatcher.bot_data:
+        # first run with the expiry scheduler: the deadlines are taken from chat_data this time only
+        logger.info("إنشاء فهرس مواعيد انتهاء الصلاحية من بيانات الدردشات...")
+        dispatcher.bot_data[EXPIRY_DEADLINES_KEY] = {
+            chat_id: santa_deadline(get_active_santa(chat_data))
+            for chat_id, chat_data in list(dispatcher.chat_data.items())
+            if ACTIVE_SECRET_SANTA_KEY in chat_data
+        }
 
-    logger.info("...انتهت وظيفة التنظيف")
+    expiry_scheduler.load(dispatcher.job_queue, dispatcher.bot_data[EXPIRY_DEADLINES_KEY])
 
 
 @fail_with_message_job
+@timed(handler_latency)
 def bot_data_cleanup(context: CallbackContext):
     logger.info("تنفيذ وظيفة التنظيف...")
 
@@ -1009,7 +1454,7 @@ def bot_data_cleanup(context: CallbackContext):
         logger.info("تنظيف %s...", RECENTLY_LEFT_KEY)
 
         chat_ids_to_pop = []
-        for chat_id, left_dt in context.dispatcher.bot_data[RECENTLY_LEFT_KEY].items():
+        for chat_id, left_dt in list(context.dispatcher.bot_data[RECENTLY_LEFT_KEY].items()):
             now = utilities.now()
             diff_seconds = (now - left_dt).total_seconds()
             if diff_seconds <= Time.WEEK_4:
@@ -1022,45 +1467,27 @@ def bot_data_cleanup(context: CallbackContext):
             logger.debug("إزالة الدردشة %d من قائمة الدردشات التي غادرتها مؤخراً", chat_id)
             context.dispatcher.bot_data[RECENTLY_LEFT_KEY].pop(chat_id, None)
 
-    if RECENTLY_STARTED_SANTAS_KEY in context.bot_data:
-        logger.info("تنظيف %s...", RECENTLY_STARTED_SANTAS_KEY)
-
-        chat_ids_to_pop = []
-        logger.debug("عدد الدردشات المخزنة حالياً: %d", len(context.bot_data[RECENTLY_STARTED_SANTAS_KEY]))
-        for chat_id, chat_santas in context.bot_data[RECENTLY_STARTED_SANTAS_KEY].items():
-            santa_ids_to_pop = []
-            for santa_message_id, santa_dict in chat_santas.items():
-                santa = SecretSanta.from_dict(santa_dict)
-                now = utilities.now()
-                diff_seconds = (now - santa.started_on).total_seconds()
-                if diff_seconds <= Time.WEEK_2:
-                    continue
-
-                santa_ids_to_pop.append(santa_message_id)
-
-            logger.debug("%d santa_ids لإزالتها", len(santa_ids_to_pop))
-            for santa_id in santa_ids_to_pop:
-                logger.debug("إزالة santa_id %d من chat_id %d", santa_id, chat_id)
-                chat_santas.pop(santa_id, None)
-
-            if not chat_santas:
-                chat_ids_to_pop.append(chat_id)
-
-        logger.debug("%d chat_ids لإزالتها", len(chat_ids_to_pop))
-        for chat_id in chat_ids_to_pop:
-            logger.debug("إزالة chat_id %d لأن dict الخاص به الآن فارغ", chat_id)
-            context.bot_data[RECENTLY_STARTED_SANTAS_KEY].pop(chat_id, None)
+    logger.info("تنظيف أرشيف أسر سانتا التي بدأت...")
+    santa_archive.delete_started_before(utilities.now() - datetime.timedelta(seconds=Time.WEEK_2))
 
     logger.info("...انتهت تنفيذ الوظيفة")
 
 
-def main():
-    dispatcher = updater.dispatcher
+def log_stats(_):
+    logger.info("إحصائيات الإرسال: %s", outbound_scheduler.stats())
+    logger.info("إحصائيات ذاكرة المشرفين المؤقتة: %s", admin_cache.stats())
+    logger.info("إحصائيات ذاكرة لوحات المفاتيح المؤقتة: %s", keyboards.cache_info())
+    logger.info("مواعيد انتهاء الصلاحية: %d مجدولة، %d منتهية", len(expiry_scheduler), expiry_scheduler.fired)
+    logger.info("زمن المعالجات: %s", handler_latency.summary(limit=10))
+    logger.info("زمن استدعاءات Bot API: %s", api_latency.summary(limit=10))
+
 
+def register_handlers(dispatcher: Dispatcher):
     dispatcher.add_handler(MessageHandler(NewGroup(), on_new_group_chat))
     dispatcher.add_handler(MessageHandler(Filters.status_update.migrate, on_supergroup_migration))
 
     dispatcher.add_handler(CommandHandler(["ongoing"], admin_ongoing_command, filters=Filters.chat_type.private))
+    dispatcher.add_handler(CommandHandler(["perf"], admin_perf_command, filters=Filters.chat_type.private))
 
     dispatcher.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/start (-?\d+)"), on_join_deeplink))
     dispatcher.add_handler(CommandHandler(["start", "help"], on_help, filters=Filters.chat_type.private))
@@ -1075,23 +1502,77 @@ def main():
     dispatcher.add_handler(CallbackQueryHandler(on_leave_button_group, pattern=r'^leave$'))
     dispatcher.add_handler(CallbackQueryHandler(on_cancel_button, pattern=r'^cancel$'))
     dispatcher.add_handler(CallbackQueryHandler(on_revoke_button, pattern=r'^revoke$'))
+    dispatcher.add_handler(CallbackQueryHandler(on_participants_button, pattern=r'^participants$'))
 
     dispatcher.add_handler(CallbackQueryHandler(on_leave_button_private, pattern=r'^private:leave:(-\d+)$'))
     dispatcher.add_handler(CallbackQueryHandler(on_update_name_button_private, pattern=r'^private:updatename:(-\d+)$'))
+    dispatcher.add_handler(CallbackQueryHandler(on_participants_page_button_private, pattern=r'^private:participants:(-\d+):(\d+)$'))
 
     dispatcher.add_handler(ChatMemberHandler(on_my_chat_member_update, ChatMemberHandler.MY_CHAT_MEMBER))
+    dispatcher.add_handler(ChatMemberHandler(on_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
 
-    updater.job_queue.run_repeating(close_old_secret_santas, interval=Time.HOUR_6, first=Time.MINUTE_30)
-    updater.job_queue.run_repeating(bot_data_cleanup, interval=Time.DAY_1, first=Time.HOUR_6)
+    dispatcher.job_queue.run_repeating(bot_data_cleanup, interval=Time.DAY_1, first=Time.HOUR_6)
+    dispatcher.job_queue.run_repeating(log_stats, interval=Time.MINUTE_30, first=Time.MINUTE_30)
 
-    updater.bot.set_my_commands([])  # تأكد من أن البوت ليس لديه أي أمر محدد...
-    updater.bot.set_my_commands(  # ...ثم تعيين النطاق للدردشات الخاصة
-        commands=Commands.PRIVATE,
-        scope=BotCommandScopeAllPrivateChats()
-    )
-    updater.bot.set_my_commands(  # ...ثم تعيين النطاق لمديري المجموعة
-        commands=Commands.GROUP_ADMINISTRATORS,
-        scope=BotCommandScopeAllChatAdministrators()
+
+def setup(dispatcher: Dispatcher):
+    """Index the loaded data, register the handlers and resume what was interrupted: everything but the network"""
+
+    with utilities.timer(startup_timings, "chat index"):
+        chat_index.build(dispatcher.chat_data, count_participants=lambda value: SecretSanta.load(value).get_participants_count())
+
+    with utilities.timer(startup_timings, "expiry index"):
+        load_expiry_deadlines(dispatcher)
+
+    with utilities.timer(startup_timings, "handlers"):
+        register_handlers(dispatcher)
+        migrate_recently_started_santas(dispatcher)
+        resume_matches_delivery(dispatcher)
+
+    with utilities.timer(startup_timings, "metrics"):
+        midnight = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        started_today.inc(santa_archive.count_started_since(midnight))
+        for chat_santas in dispatcher.bot_data.get(DELIVERING_SANTAS_KEY, {}).values():
+            started_today.inc(sum(1 for santa in chat_santas.values() if santa.started_on >= midnight))
+
+
+def main():
+    dispatcher = updater.dispatcher
+
+    setup(dispatcher)
+
+    with utilities.timer(startup_timings, "metrics server"):
+        metrics_config = config.get('metrics', {})
+        if metrics_config.get('port', 0):
+            serve_metrics(metrics, metrics_config.get('host', '127.0.0.1'), metrics_config['port'])
+
+    with utilities.timer(startup_timings, "set_my_commands"):
+        updater.bot.set_my_commands([])  # تأكد من أن البوت ليس لديه أي أمر محدد...
+        updater.bot.set_my_commands(  # ...ثم تعيين النطاق للدردشات الخاصة
+            commands=Commands.PRIVATE,
+            scope=BotCommandScopeAllPrivateChats()
+        )
+        updater.bot.set_my_commands(  # ...ثم تعيين النطاق لمديري المجموعة
+            commands=Commands.GROUP_ADMINISTRATORS,
+            scope=BotCommandScopeAllChatAdministrators()
+        )
+
+    logger.info(
+        "وقت بدء التشغيل: %s",
+        ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup_timings.items())
     )
 
-    allowed_updates = ["message", "callback_query", "my_chat_member"]  
+    allowed_updates = ["message", "callback_query", "my_chat_member", "chat_member"]
+
+    logger.info("بدء الاستطلاع...")
+    updater.start_polling(allowed_updates=allowed_updates)
+    updater.idle()
+
+    santa_archive.close()
+    utilities.error_reporter.stop()
+    if update_capture:
+        update_capture.close()
+
+
+if __name__ == '__main__':
+    main()
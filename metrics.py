@@ -0,0 +1,118 @@
+import datetime
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+
+
+class DailyCounter:
+    """A counter that starts again from zero every day"""
+
+    def __init__(self, value: int = 0):
+        self._day = datetime.date.today()
+        self._value = value
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        today = datetime.date.today()
+        if today != self._day:
+            self._day = today
+            self._value = 0
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self._roll()
+            self._value += amount
+
+    def value(self) -> int:
+        with self._lock:
+            self._roll()
+            return self._value
+
+
+class Metrics:
+    """Counters and gauges kept up to date by the handlers as things happen, so that reading them costs nothing.
+    A gauge can also be a function, called when the gauge is read (eg. the size of an index we already keep)"""
+
+    def __init__(self, namespace: str = "secret_santa"):
+        self.namespace = namespace
+
+        self._metrics: Dict[str, Tuple[str, str]] = {}  # name -> (type, help), in registration order
+        self._values: Dict[str, float] = {}
+        self._funcs: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str):
+        self._metrics[name] = (COUNTER, help_text)
+        self._values.setdefault(name, 0)
+
+    def gauge(self, name: str, help_text: str, func: Optional[Callable[[], float]] = None):
+        self._metrics[name] = (GAUGE, help_text)
+        if func:
+            self._funcs[name] = func
+        else:
+            self._values.setdefault(name, 0)
+
+    def inc(self, name: str, amount: float = 1):
+        with self._lock:
+            self._values[name] += amount
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self._values[name] = value
+
+    def value(self, name: str) -> float:
+        func = self._funcs.get(name)
+        if func:
+            return func()
+
+        with self._lock:
+            return self._values[name]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {name: self.value(name) for name in self._metrics}
+
+    def prometheus_text(self) -> str:
+        """The metrics in Prometheus' text exposition format"""
+
+        lines = []
+        for name, value in self.snapshot().items():
+            metric_type, help_text = self._metrics[name]
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            lines.append(f"{full_name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def serve(metrics: Metrics, host: str = "127.0.0.1", port: int = 9120) -> ThreadingHTTPServer:
+    """Serve the metrics on http://host:port/metrics, from a daemon thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("%s - %s", self.address_string(), format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics_server", daemon=True).start()
+    logger.info("serving metrics on http://%s:%d/metrics", *server.server_address[:2])
+
+    return server
@@ -1,59 +1,204 @@
-# source: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
+# originally based on: http://code.activestate.com/recipes/325905-memoize-decorator-with-timeout/#c1
 import logging
-
+import threading
 import time
+from collections import OrderedDict
 from functools import wraps
+from typing import Callable, Hashable, Optional
 
 logger = logging.getLogger(__name__)
 
 
-class MWT:
-    """Memoize With Timeout"""
-    _caches = {}
-    _timeouts = {}
+class _Loading:
+    """A value being loaded by a thread, that other threads asking for the same key can wait for"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exception: Optional[BaseException] = None
+        self.stale = False  # the value changed while it was being loaded: don't cache what we got
+
 
-    def __init__(self, timeout=2):
+class TTLCache:
+    """Thread-safe cache with a maximum size (the least recently used entries are evicted first) and a timeout
+    after which entries expire. Expired entries are dropped lazily, when they are looked up or evicted"""
+
+    def __init__(self, timeout: float, maxsize: int = 1024):
         self.timeout = timeout
+        self.maxsize = maxsize
+
+        self._data = OrderedDict()  # key -> (value, expiry time), least recently used first
+        self._loading = {}  # key -> _Loading
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _get(self, key: Hashable):
+        """Returns (True, value) or (False, None). The lock must be held"""
+
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+
+        value, expires_on = entry
+        if time.monotonic() >= expires_on:
+            del self._data[key]
+            self.expirations += 1
+            return False, None
+
+        self._data.move_to_end(key)
+        return True, value
+
+    def _set(self, key: Hashable, value, timeout: Optional[float] = None):
+        """The lock must be held"""
+
+        self._data[key] = (value, time.monotonic() + (self.timeout if timeout is None else timeout))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value, timeout: Optional[float] = None):
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def update(self, key: Hashable, func: Callable[[object], object]) -> bool:
+        """Replace the cached value for key with func(value), without changing when it expires. Returns false if
+        there is no (unexpired) value for key"""
+
+        with self._lock:
+            if key in self._loading:
+                self._loading[key].stale = True
+
+            found, value = self._get(key)
+            if not found:
+                return False
+
+            self._data[key] = (func(value), self._data[key][1])
+            return True
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            if key in self._loading:
+                self._loading[key].stale = True
+
+            entry = self._data.pop(key, None)
+
+        return entry[0] if entry else default
+
+    def get_or_load(
+            self,
+            key: Hashable,
+            loader: Callable[[], object],
+            timeout_func: Optional[Callable[[object], float]] = None
+    ):
+        """Return the cached value for key, or load it with loader(). If another thread is already loading the same
+        key, wait for its result instead of calling loader() too (its exception is raised, if it fails).
+        timeout_func(value), if passed, returns the timeout of the loaded value"""
+
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            loading = self._loading.get(key)
+            owner = loading is None
+            if owner:
+                loading = self._loading[key] = _Loading()
+
+        if not owner:
+            loading.event.wait()
+            if loading.exception:
+                raise loading.exception
+
+            return loading.value
+
+        try:
+            loading.value = loader()
+        except BaseException as e:
+            loading.exception = e
+            raise
+        else:
+            timeout = timeout_func(loading.value) if timeout_func else None
+            with self._lock:
+                if not loading.stale:
+                    self._set(key, loading.value, timeout)
+
+            return loading.value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+            loading.event.set()
 
     def collect(self):
-        """Clear cache of results which have timed out"""
-        t = time.time()
+        """Drop all the expired entries"""
 
-        for func in self._caches:
-            cache = {}
+        now = time.monotonic()
+        with self._lock:
+            expired_keys = [key for key, (_, expires_on) in self._data.items() if now >= expires_on]
+            for key in expired_keys:
+                del self._data[key]
 
-            for key in self._caches[func]:
-                if (t - self._caches[func][key][1]) < self._timeouts[func]:
-                    cache[key] = self._caches[func][key]
+            self.expirations += len(expired_keys)
 
-            self._caches[func] = cache
+    def clear(self):
+        with self._lock:
+            self._data.clear()
 
-    def __call__(self, f):
-        cache = self._caches[f] = {}
-        self._timeouts[f] = self.timeout
+    def __len__(self):
+        return len(self._data)
 
-        @wraps(f)
-        def func(*args, **kwargs):
-            kw = sorted(kwargs.items())
-            key = (args, tuple(kw))
-            t = time.time()
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                size=len(self._data),
+                maxsize=self.maxsize,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+            )
 
-            try:
-                v = cache[key]
-                logger.debug("cache: hit")
 
-                if (t - v[1]) > self.timeout:
-                    raise KeyError
+class MWT:
+    """Memoize With Timeout. Every decorated function gets its own TTLCache, keyed by the call arguments"""
+
+    def __init__(self, timeout=2, maxsize=1024):
+        self.timeout = timeout
+        self.maxsize = maxsize
 
-            except KeyError:
-                logger.debug("cache: new")
-                v = cache[key] = f(*args, **kwargs), t
+    @staticmethod
+    def make_key(args, kwargs):
+        return args, tuple(sorted(kwargs.items()))
 
-            return v[0]
+    def __call__(self, f):
+        cache = TTLCache(self.timeout, self.maxsize)
+
+        @wraps(f)
+        def func(*args, **kwargs):
+            return cache.get_or_load(self.make_key(args, kwargs), lambda: f(*args, **kwargs))
 
-        def clear_cache():
-            self._caches[f].clear()
+        def invalidate(*args, **kwargs):
+            cache.pop(self.make_key(args, kwargs))
 
-        func.clear_cache = clear_cache
+        func.cache = cache
+        func.clear_cache = cache.clear
+        func.invalidate = invalidate
 
         return func
@@ -0,0 +1,105 @@
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# bucket upper bounds, in seconds: 1ms to ~2 minutes, each 25% larger than the previous one
+BUCKETS = tuple(0.001 * 1.25 ** i for i in range(53))
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    """Counts of the observed durations per bucket: constant memory, percentiles are approximated with the upper
+    bound of the bucket they fall in (at most 25% more than the real value)"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is for anything above the largest bucket
+        self.count = 0
+        self.errors = 0
+        self.total = 0.
+        self.max = 0.
+
+    def observe(self, seconds: float, error: bool = False):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if error:
+            self.errors += 1
+
+    def percentile(self, percentile: float) -> float:
+        if not self.count:
+            return 0.
+
+        rank = percentile / 100 * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+
+        return self.max
+
+
+class LatencyRecorder:
+    """A Histogram per name (eg. per handler, or per Bot API method)"""
+
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+
+            histogram.observe(seconds, error)
+
+    def report(self, percentiles: Iterable[float] = PERCENTILES) -> List[Tuple[str, int, int, List[float], float]]:
+        """(name, count, errors, [percentiles], max) rows, the slowest (by total time) first"""
+
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda item: item[1].total, reverse=True)
+            return [
+                (name, h.count, h.errors, [h.percentile(p) for p in percentiles], h.max)
+                for name, h in histograms
+            ]
+
+    def summary(self, limit: Optional[int] = None) -> str:
+        """One line, for the logs"""
+
+        rows = self.report()[:limit]
+        return ", ".join(
+            f"{name} n={count} err={errors} p50={p50 * 1000:.0f}ms p90={p90 * 1000:.0f}ms p99={p99 * 1000:.0f}ms"
+            for name, count, errors, (p50, p90, p99), _ in rows
+        )
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+def timed(recorder: LatencyRecorder, name: Optional[str] = None):
+    """Decorator that records the wall time of every call of the function, and whether it raised"""
+
+    def real_decorator(func):
+        recorded_name = name or func.__name__
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                recorder.record(recorded_name, time.perf_counter() - start, error)
+
+        return wrapped
+    return real_decorator
@@ -0,0 +1,298 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, List, Tuple, Any, Sequence, Union
+
+# noinspection PyPackageRequirements
+from telegram.error import RetryAfter
+# noinspection PyPackageRequirements
+from telegram.utils.request import Request
+
+from perf import LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second are added, up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def try_acquire(self) -> float:
+        """Take a token if available. Returns 0 if it has been taken, otherwise how many seconds to wait before
+        trying again"""
+
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Empty the bucket so that the next token is available in `seconds`"""
+
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill()
+            return self._tokens >= self.capacity
+
+
+class Priority:
+    HIGH = 0  # messages someone is waiting for (eg. matches)
+    NORMAL = 1
+    LOW = 2  # cosmetic, eg. edits of the santa message
+
+    NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+
+class OutboundScheduler:
+    """Paces the Bot API calls that send something to a chat: every call takes a token from the bucket of its
+    chat, then from a global bucket. Calls waiting for the global bucket are served in priority order, so that a
+    burst of low priority calls can't delay the high priority ones"""
+
+    # Telegram's limits: ~30 messages per second overall, ~20 messages per minute in the same group and ~1 message
+    # per second in the same private chat
+    GLOBAL_RATE = 30
+    GROUP_RATE = 20 / 60
+    GROUP_BURST = 20
+    PRIVATE_RATE = 1
+    PRIVATE_BURST = 3
+
+    PRIORITIES = {
+        "sendMessage": Priority.HIGH,
+        "editMessageText": Priority.LOW,
+        "editMessageReplyMarkup": Priority.LOW,
+        "sendChatAction": Priority.LOW,
+    }
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, max_chat_buckets: int = 10000):
+        self.global_bucket = TokenBucket(global_rate)
+        self.max_chat_buckets = max_chat_buckets
+
+        self._chat_buckets = {}
+        self._condition = threading.Condition()
+        self._waiting = []  # heap of (priority, sequence number)
+        self._sequence = itertools.count()
+
+        self._max_depth = 0
+        self._sent = {priority: 0 for priority in Priority.NAMES}
+        self._waited = {priority: 0. for priority in Priority.NAMES}
+        self._retry_after_count = 0
+
+    @staticmethod
+    def is_paced(method: str) -> bool:
+        return method.startswith(("send", "edit", "copy", "forward"))
+
+    def priority(self, method: str) -> int:
+        return self.PRIORITIES.get(method, Priority.NORMAL)
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        with self._condition:
+            if chat_id in self._chat_buckets:
+                return self._chat_buckets[chat_id]
+
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                # full buckets behave exactly like new ones, they can be dropped
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_full()}
+
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.PRIVATE_RATE, self.PRIVATE_BURST)
+            else:
+                bucket = TokenBucket(self.GROUP_RATE, self.GROUP_BURST)
+
+            self._chat_buckets[chat_id] = bucket
+            return bucket
+
+    def acquire(self, chat_id: Optional[Union[int, str]], priority: int):
+        start = time.monotonic()
+        if chat_id is not None:
+            self._chat_bucket(chat_id).acquire()
+
+        with self._condition:
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            self._max_depth = max(self._max_depth, len(self._waiting))
+            try:
+                while True:
+                    if self._waiting[0] != entry:
+                        self._condition.wait()
+                        continue
+
+                    wait = self.global_bucket.try_acquire()
+                    if not wait:
+                        break
+
+                    self._condition.wait(wait)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+            self._sent[priority] += 1
+            self._waited[priority] += time.monotonic() - start
+
+    def retry_after(self, chat_id: Optional[Union[int, str]], seconds: float):
+        self._retry_after_count += 1
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(seconds)
+        else:
+            self.global_bucket.pause(seconds)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "queue_depth": len(self._waiting),
+                "max_queue_depth": self._max_depth,
+                "chat_buckets": len(self._chat_buckets),
+                "retry_after": self._retry_after_count,
+                "sent": {Priority.NAMES[p]: count for p, count in self._sent.items()},
+                "avg_wait": {
+                    Priority.NAMES[p]: (self._waited[p] / self._sent[p] if self._sent[p] else 0.)
+                    for p in self._sent
+                },
+            }
+
+
+class BoundedExecutor:
+    """Thread pool that accepts at most `bound` calls at a time (running or queued): submit() blocks while it's full.
+    Exceptions raised by the calls are logged"""
+
+    def __init__(self, workers: int, bound: int, thread_name_prefix: str = ""):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=thread_name_prefix)
+        self._semaphore = threading.BoundedSemaphore(max(bound, workers, 1))
+
+    def submit(self, func: Callable, *args, **kwargs):
+        self._semaphore.acquire()
+
+        def run():
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                logger.error("error in %s: %s", getattr(func, "__name__", func), str(e), exc_info=True)
+            finally:
+                self._semaphore.release()
+
+        return self._executor.submit(run)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+class ScheduledRequest(Request):
+    """Request that passes every call that sends something through an OutboundScheduler, and retries the calls
+    that fail with RetryAfter (up to max_retries times) after having paused the chat's bucket.
+    If a recorder is passed, the latency of every HTTP call is recorded per API method (the time spent waiting for
+    the scheduler is not included: see OutboundScheduler.stats())"""
+
+    __slots__ = ("scheduler", "max_retries", "recorder")
+
+    UNTIMED_METHODS = ("getUpdates",)  # long polling: its duration is mostly the polling timeout
+
+    def __init__(self, scheduler: OutboundScheduler, max_retries: int = 3, recorder: Optional[LatencyRecorder] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.recorder = recorder
+
+    def _post(self, method: str, url: str, data: dict, timeout: float = None):
+        if not self.recorder or method in self.UNTIMED_METHODS:
+            return super().post(url, data, timeout=timeout)
+
+        start = time.perf_counter()
+        error = True
+        try:
+            result = super().post(url, data, timeout=timeout)
+            error = False
+            return result
+        finally:
+            self.recorder.record(method, time.perf_counter() - start, error)
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        method = url.rsplit("/", 1)[-1]
+        if not self.scheduler.is_paced(method):
+            return self._post(method, url, data, timeout=timeout)
+
+        chat_id = data.get("chat_id", None)
+        priority = self.scheduler.priority(method)
+        retries = 0
+        while True:
+            self.scheduler.acquire(chat_id, priority)
+            try:
+                return self._post(method, url, data, timeout=timeout)
+            except RetryAfter as e:
+                if retries >= self.max_retries:
+                    raise
+
+                retries += 1
+                logger.warning("%s to %s: retry after %ss (retry %d/%d)", method, chat_id, e.retry_after, retries, self.max_retries)
+                self.scheduler.retry_after(chat_id, e.retry_after)
+
+
+def fan_out(
+        func: Callable[[Any], Any],
+        items: Sequence,
+        workers: int,
+        on_progress: Optional[Callable[[int, int], None]] = None
+) -> List[Tuple[Any, Any, Optional[Exception]]]:
+    """Run func on every item on a pool of `workers` threads. on_progress(done, total) is called (from the worker
+    threads) every time a call completes.
+    Returns a list of (item, result, exception) tuples in the same order of the items: exceptions raised by func
+    are returned, not raised"""
+
+    results = [None] * len(items)
+    done_count = 0
+    lock = threading.Lock()
+
+    def run(index: int, item):
+        nonlocal done_count
+
+        try:
+            results[index] = (item, func(item), None)
+        except Exception as e:
+            results[index] = (item, None, e)
+
+        with lock:
+            done_count += 1
+            done = done_count
+
+        if on_progress:
+            try:
+                on_progress(done, len(items))
+            except Exception as e:
+                logger.warning("error while reporting fan-out progress: %s", str(e))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="fan_out") as executor:
+        for i, item in enumerate(items):
+            executor.submit(run, i, item)
+
+    return results
@@ -0,0 +1,136 @@
+import logging
+import threading
+from typing import Dict, Hashable, Optional
+
+# noinspection PyPackageRequirements
+from telegram import Bot
+# noinspection PyPackageRequirements
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4000  # Telegram's limit is 4096 characters, some room is left for the header
+
+
+class _Entry:
+    __slots__ = ("text", "count")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.count = 1
+
+
+class ErrorReporter:
+    """Reports errors to the log chat without making the caller wait: report() only records the error, a daemon
+    thread sends a digest every `interval` seconds. Errors with the same key (eg. handler, exception type and
+    message) are sent once per digest, with how many times they happened. At most `max_keys` different errors are
+    kept between two digests and at most `max_messages` messages are sent per digest: the rest are only counted"""
+
+    def __init__(self, chat_id: int, interval: float = 10., max_keys: int = 100, max_messages: int = 3):
+        self.chat_id = chat_id
+        self.interval = interval
+        self.max_keys = max_keys
+        self.max_messages = max_messages
+
+        self.bot: Optional[Bot] = None
+        self.reported = 0
+        self.sent = 0
+
+        self._pending: Dict[Hashable, _Entry] = {}  # in order of first occurrence
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def report(self, bot: Bot, key: Hashable, text: str):
+        if not self.chat_id:
+            logger.debug("can't report to Telegram: no log chat configured")
+            return
+
+        with self._lock:
+            self.bot = bot
+            self.reported += 1
+
+            entry = self._pending.get(key)
+            if entry:
+                entry.count += 1
+            elif len(self._pending) < self.max_keys:
+                self._pending[key] = _Entry(text)
+            else:
+                self._dropped += 1
+
+            if not self._thread and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name="error_reporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake_up.wait(self.interval)
+            self._wake_up.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("error while reporting errors: %s", str(e), exc_info=True)
+
+    def _digest(self) -> list:
+        """The texts of the messages to send for the pending errors, which are cleared"""
+
+        with self._lock:
+            entries = list(self._pending.values())
+            dropped = self._dropped
+            self._pending = {}
+            self._dropped = 0
+
+        if not entries and not dropped:
+            return []
+
+        header = f"#{self.bot.username}"
+        messages = []
+        current = header
+        for i, entry in enumerate(entries):
+            line = entry.text if entry.count == 1 else f"{entry.text} (x{entry.count})"
+            line = line[:MAX_MESSAGE_LENGTH - len(header) - 2]
+            if len(current) + len(line) + 2 > MAX_MESSAGE_LENGTH:
+                if len(messages) + 1 >= self.max_messages:
+                    dropped += sum(e.count for e in entries[i:])
+                    break
+
+                messages.append(current)
+                current = header
+
+            current = f"{current}\n\n{line}"
+
+        if dropped:
+            current = f"{current}\n\n...and {dropped} more errors"
+
+        messages.append(current)
+        return messages
+
+    def flush(self):
+        for text in self._digest():
+            try:
+                self.bot.send_message(self.chat_id, text)
+            except TelegramError as e:
+                logger.warning("exception while reporting errors to chat %d: %s", self.chat_id, str(e))
+                logger.debug("trying again with parse_mode disabled...")
+                try:
+                    self.bot.send_message(self.chat_id, text, parse_mode=None)
+                except TelegramError as e:
+                    logger.error("can't report errors to chat %d: %s", self.chat_id, str(e))
+                    continue
+
+            self.sent += 1
+
+    def stop(self):
+        """Send what's pending and stop the thread"""
+
+        with self._lock:
+            self._stopping = True
+            thread = self._thread
+
+        if thread:
+            self._wake_up.set()
+            thread.join()
+
+        self.flush()
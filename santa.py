@@ -1,6 +1,8 @@
 import datetime
+import itertools
+import sys
 from functools import wraps
-from typing import Optional, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 from telegram import User
 
@@ -8,6 +10,7 @@ import utilities
 from config import config
 
 NAME_MAX_LENGTH = 100
+NOT_DELIVERED = 0  # match_message_id of the participants whose match couldn't be sent (message ids start from 1)
 
 
 def update_time(func):
@@ -20,7 +23,75 @@ def update_time(func):
     return wrapped
 
 
+class Participant:
+    __slots__ = ("name", "match_message_id", "last_join_message_id", "receiver_id")
+
+    def __init__(
+            self,
+            name: str,
+            match_message_id: Optional[int] = None,
+            last_join_message_id: Optional[int] = None,
+            receiver_id: Optional[int] = None,
+    ):
+        self.name = sys.intern(name)
+        self.match_message_id = match_message_id
+        self.last_join_message_id = last_join_message_id
+        self.receiver_id = receiver_id  # who this participant is the santa of, once matched
+
+    @classmethod
+    def from_dict(cls, participant_dict: dict):
+        return cls(
+            participant_dict["name"],
+            participant_dict["match_message_id"],
+            participant_dict["last_join_message_id"],
+            participant_dict.get("receiver_id", None),
+        )
+
+    def fields(self) -> tuple:
+        return self.name, self.match_message_id, self.last_join_message_id, self.receiver_id
+
+    def dict(self):
+        return {
+            "name": self.name,
+            "match_message_id": self.match_message_id,
+            "last_join_message_id": self.last_join_message_id,
+            "receiver_id": self.receiver_id,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Participant):
+            return NotImplemented
+
+        return self.fields() == other.fields()
+
+
 class SecretSanta:
+    """An active (or recently started) Secret Santa. It's stored as it is in chat_data/bot_data, and it's pickled
+    as a flat tuple (see __getstate__). Every change sets the dirty flag, which the persistence clears once it has
+    written the santa: a santa that is not dirty does not need to be saved again"""
+
+    __slots__ = (
+        "origin_message_id",  # message received from the user in the group
+        "santa_message_id",  # message we send in the group
+        "participants",
+        "created_on",
+        "updated_on",
+        "creator_id",
+        "creator_name",
+        "chat_id",
+        "chat_title",
+        "started",
+        "started_on",
+        "dirty",
+        # not persisted:
+        "_names",  # casefolded name -> ids of the participants with that name
+        "_version",  # incremented on every change to the participants
+        "_mentions",  # user id -> (name, escaped mention)
+        "_participants_html",  # (_version, rendered participants list)
+    )
+
+    STATE_VERSION = 2  # 2: participants have a receiver_id
+
     def __init__(
             self,
             origin_message_id: int,
@@ -29,26 +100,30 @@ class SecretSanta:
             chat_id: int,
             chat_title: str,
             santa_message_id: Optional[int] = None,
-            participants: Optional[dict] = None,
+            participants: Optional[Dict[int, Union[Participant, dict]]] = None,
             created_on: Optional[datetime.datetime] = None,
             updated_on: Optional[datetime.datetime] = None,
             started: bool = False,
             started_on: Optional[datetime.datetime] = None,
     ):
         now = utilities.now()
-        self._santa_dict = {
-            "origin_message_id": origin_message_id,  # message received from the user in the group
-            "santa_message_id": santa_message_id,  # message we send in the group
-            "participants": participants or {},
-            "created_on": created_on or now,
-            "updated_on": updated_on or now,
-            "user_id": user_id,
-            "user_name": user_name,
-            "chat_id": chat_id,
-            "chat_title": chat_title,
-            "started": started,
-            "started_on": started_on,
+        self.origin_message_id: int = origin_message_id
+        self.santa_message_id: Optional[int] = santa_message_id
+        self.participants: Dict[int, Participant] = {
+            user_id: p if isinstance(p, Participant) else Participant.from_dict(p)
+            for user_id, p in (participants or {}).items()
         }
+        self._build_names_index()
+        self._reset_render_cache()
+        self.created_on: datetime.datetime = created_on or now
+        self.updated_on: datetime.datetime = updated_on or now
+        self.creator_id: int = user_id
+        self.creator_name: str = user_name
+        self.chat_id: int = chat_id
+        self.chat_title: str = chat_title
+        self.started: bool = started
+        self.started_on: Optional[datetime.datetime] = started_on
+        self.dirty = True  # not saved yet
 
     @classmethod
     def from_dict(cls, santa_dict: dict):
@@ -66,60 +141,170 @@ class SecretSanta:
             started_on=santa_dict.get("started_on", None),
         )
 
+    @classmethod
+    def load(cls, value: Union["SecretSanta", dict]) -> "SecretSanta":
+        """Accepts both a SecretSanta and the dict older versions used to store"""
+
+        if isinstance(value, SecretSanta):
+            return value
+
+        return cls.from_dict(value)
+
     def dict(self):
-        return self._santa_dict
+        return {
+            "origin_message_id": self.origin_message_id,
+            "santa_message_id": self.santa_message_id,
+            "participants": {user_id: participant.dict() for user_id, participant in self.participants.items()},
+            "created_on": self.created_on,
+            "updated_on": self.updated_on,
+            "user_id": self.creator_id,
+            "user_name": self.creator_name,
+            "chat_id": self.chat_id,
+            "chat_title": self.chat_title,
+            "started": self.started,
+            "started_on": self.started_on,
+        }
 
-    @property
-    def creator_id(self):
-        return self._santa_dict["user_id"]
+    def __getstate__(self):
+        participants = tuple((user_id, *p.fields()) for user_id, p in self.participants.items())
+        return (
+            self.STATE_VERSION,
+            self.origin_message_id,
+            self.santa_message_id,
+            self.created_on,
+            self.updated_on,
+            self.creator_id,
+            self.creator_name,
+            self.chat_id,
+            self.chat_title,
+            self.started,
+            self.started_on,
+            participants,
+        )
 
-    @property
-    def creator_name(self):
-        return self._santa_dict["user_name"]
+    def __setstate__(self, state):
+        (
+            _,
+            self.origin_message_id,
+            self.santa_message_id,
+            self.created_on,
+            self.updated_on,
+            self.creator_id,
+            self.creator_name,
+            self.chat_id,
+            self.chat_title,
+            self.started,
+            self.started_on,
+            participants,
+        ) = state
+        self.participants = {user_id: Participant(*fields) for user_id, *fields in participants}
+        self._build_names_index()
+        self._reset_render_cache()
+        self.dirty = False
+
+    def __eq__(self, other):
+        if not isinstance(other, SecretSanta):
+            return NotImplemented
+
+        return self.__getstate__() == other.__getstate__()
+
+    def __setattr__(self, name, value):
+        # any assignment to a persisted attribute makes the santa dirty. Changes to the participants are marked by
+        # the methods that make them
+        object.__setattr__(self, name, value)
+        if name != "dirty" and not name.startswith("_"):
+            object.__setattr__(self, "dirty", True)
+
+    def mark_clean(self):
+        self.dirty = False
 
-    @property
-    def creator_name_escaped(self):
-        return utilities.html_escape(self.creator_name)
+    @staticmethod
+    def _name_key(name: str) -> str:
+        return name[:NAME_MAX_LENGTH].casefold()
+
+    def _build_names_index(self):
+        self._names: Dict[str, Set[int]] = {}
+        for user_id, participant in self.participants.items():
+            self._names.setdefault(self._name_key(participant.name), set()).add(user_id)
+
+    def _unindex_name(self, user_id: int, name: str):
+        name_key = self._name_key(name)
+        user_ids = self._names.get(name_key)
+        if user_ids is None:
+            return
+
+        user_ids.discard(user_id)
+        if not user_ids:
+            del self._names[name_key]
+
+    def _rename(self, user_id: int, name: str):
+        participant = self.participants[user_id]
+        self._unindex_name(user_id, participant.name)
+        participant.name = sys.intern(name)
+        self._names.setdefault(self._name_key(participant.name), set()).add(user_id)
+        self._version += 1
+        self.dirty = True
+
+    def _reset_render_cache(self):
+        self._version = 0
+        self._mentions: Dict[int, Tuple[str, str]] = {}
+        self._participants_html: Optional[Tuple[int, str]] = None
+
+    def _mention(self, user_id: int, participant: Participant) -> str:
+        # the cached mention is valid as long as the name it was rendered from didn't change
+        cached = self._mentions.get(user_id)
+        if cached and cached[0] == participant.name:
+            return cached[1]
+
+        mention = utilities.mention_escaped_by_id(user_id, participant.name)
+        self._mentions[user_id] = (participant.name, mention)
+        return mention
 
-    @property
-    def chat_id(self):
-        return self._santa_dict["chat_id"]
+    @staticmethod
+    def _participant_row(position: int, mention: str) -> str:
+        return f'<b>{position}</b>. {mention}'
 
-    @property
-    def chat_title(self):
-        return self._santa_dict["chat_title"]
+    def participants_html(self) -> str:
+        """The numbered list of the participants' mentions, one per line. Mentions are rendered again only for the
+        participants that joined or changed name since the last call, and the whole list only when it changed"""
 
-    @property
-    def chat_title_escaped(self):
-        return utilities.html_escape(self.chat_title)
+        version = self._version
+        cached = self._participants_html
+        if cached and cached[0] == version:
+            return cached[1]
 
-    @property
-    def origin_message_id(self):
-        return self._santa_dict["origin_message_id"]
+        rows = []
+        for position, (user_id, participant) in enumerate(list(self.participants.items()), start=1):
+            rows.append(self._participant_row(position, self._mention(user_id, participant)))
 
-    @property
-    def santa_message_id(self):
-        return self._santa_dict["santa_message_id"]
+        participants_html = "\n".join(rows)
+        if self._version == version:  # the participants didn't change while we were rendering them
+            self._participants_html = (version, participants_html)
 
-    @santa_message_id.setter
-    def santa_message_id(self, santa_message_id):
-        self._santa_dict["santa_message_id"] = santa_message_id
+        return participants_html
 
-    @property
-    def started(self):
-        return self._santa_dict["started"]
+    def participants_page(self, page: int, page_size: int) -> Tuple[str, int, int]:
+        """One page of the numbered participants list. Returns (page html, page, pages count): the page number is
+        clamped to the existing pages"""
+
+        pages_count = max(1, -(-len(self.participants) // page_size))
+        page = min(max(page, 0), pages_count - 1)
+        start = page * page_size
+
+        rows = []
+        page_items = itertools.islice(self.participants.items(), start, start + page_size)
+        for position, (user_id, participant) in enumerate(page_items, start=start + 1):
+            rows.append(self._participant_row(position, self._mention(user_id, participant)))
 
-    @started.setter
-    def started(self, new_value):
-        self._santa_dict["started"] = new_value
+        return "\n".join(rows), page, pages_count
 
     @property
-    def started_on(self):
-        return self._santa_dict["started_on"]
+    def creator_name_escaped(self):
+        return utilities.html_escape(self.creator_name)
 
-    @started_on.setter
-    def started_on(self, new_value):
-        self._santa_dict["started_on"] = new_value
+    @property
+    def chat_title_escaped(self):
+        return utilities.html_escape(self.chat_title)
 
     @property
     def message_id(self):
@@ -129,14 +314,6 @@ class SecretSanta:
     def id(self):
         return self.santa_message_id
 
-    @property
-    def participants(self) -> dict:
-        return self._santa_dict["participants"]
-
-    @property
-    def updated_on(self):
-        return self._santa_dict["updated_on"]
-
     @staticmethod
     def user_id(user_id: Union[int, User]):
         if isinstance(user_id, User):
@@ -144,16 +321,17 @@ class SecretSanta:
 
         return user_id
 
-    @property
-    def created_on(self):
-        return self._santa_dict["created_on"]
-
     def get_participants_count(self):
         return len(self.participants)
 
     def get_missing_count(self):
         return config.santa.min_participants - self.get_participants_count()
 
+    def is_large(self) -> bool:
+        """Whether the participants list is too long to be included in the santa message"""
+
+        return self.get_participants_count() > config.santa.get('large_threshold', 30)
+
     # @update_time
     def add(
             self,
@@ -162,12 +340,21 @@ class SecretSanta:
             join_message_id: Optional[int] = None,
     ) -> bool:
         already_a_participant = user.id in self.participants
+        if already_a_participant:
+            self._unindex_name(user.id, self.participants[user.id].name)
 
-        self._santa_dict["participants"][user.id] = {
-            "name": user.first_name[:NAME_MAX_LENGTH],
-            "match_message_id": match_message_id,
-            "last_join_message_id": join_message_id
-        }
+        participant = Participant(user.first_name[:NAME_MAX_LENGTH], match_message_id, join_message_id)
+        self.participants[user.id] = participant
+        self._names.setdefault(self._name_key(participant.name), set()).add(user.id)
+
+        cached = self._participants_html
+        self._version += 1
+        if cached and cached[0] == self._version - 1 and not already_a_participant:
+            # a new participant is appended at the end of the list: no need to render it all again
+            row = self._participant_row(len(self.participants), self._mention(user.id, participant))
+            self._participants_html = (self._version, f"{cached[1]}\n{row}" if cached[1] else row)
+
+        self.dirty = True
 
         return already_a_participant
 
@@ -177,24 +364,29 @@ class SecretSanta:
         if isinstance(user, User):
             name = user.first_name
 
-        self._santa_dict["participants"][user.id]["name"] = name[:NAME_MAX_LENGTH]
+        self._rename(user.id, name[:NAME_MAX_LENGTH])
 
     def is_duplicate_name(self, name):
-        name_lower = name.lower()[:NAME_MAX_LENGTH]
-        for user_id, user_data in self.participants.items():
-            if user_data["name"].lower() == name_lower:
-                return name[:NAME_MAX_LENGTH]  # we return the saved name (that is, shortened), for clarity
+        if self._names.get(self._name_key(name)):
+            return name[:NAME_MAX_LENGTH]  # we return the saved name (that is, shortened), for clarity
 
         return False
 
     # @update_time
     def remove(self, user: Union[int, User]) -> bool:
         user_id = self.user_id(user)
-        result = bool(self._santa_dict["participants"].pop(user_id, None))
-        return result
+        participant = self.participants.pop(user_id, None)
+        if participant is None:
+            return False
+
+        self._unindex_name(user_id, participant.name)
+        self._mentions.pop(user_id, None)
+        self._version += 1
+        self.dirty = True
+        return True
 
     def updated(self):
-        self._santa_dict["updated_on"] = utilities.now()
+        self.updated_on = utilities.now()
 
     def start(self):
         self.started = True
@@ -210,37 +402,64 @@ class SecretSanta:
 
     def get_user_match_message_id(self, user: Union[int, User]) -> int:
         user_id = self.user_id(user)
-        # noinspection PyTypeChecker
-        return self._santa_dict["participants"][user_id]["match_message_id"]
+        return self.participants[user_id].match_message_id
 
     def set_user_match_message_id(self, user: Union[int, User], message_id: int):
         user_id = self.user_id(user)
-        self._santa_dict["participants"][user_id]["match_message_id"] = message_id
+        self.participants[user_id].match_message_id = message_id
+        self.dirty = True
+
+    def set_user_receiver(self, user: Union[int, User], receiver_id: int):
+        user_id = self.user_id(user)
+        self.participants[user_id].receiver_id = receiver_id
+        self.dirty = True
+
+    def matched_pairs(self) -> List[Tuple[int, int]]:
+        """(santa, receiver) pairs of a started Secret Santa"""
+
+        return [(user_id, p.receiver_id) for user_id, p in self.participants.items() if p.receiver_id is not None]
+
+    def pending_deliveries(self, limit: Optional[int] = None) -> List[Tuple[int, int]]:
+        """(santa, receiver) pairs whose match message hasn't been sent yet, at most `limit`"""
+
+        pending = (
+            (user_id, p.receiver_id)
+            for user_id, p in self.participants.items()
+            if p.receiver_id is not None and p.match_message_id is None
+        )
+        return list(itertools.islice(pending, limit))
+
+    def delivery_progress(self) -> Tuple[int, int]:
+        """(matches sent or given up on, matches to send)"""
+
+        matched = [p for p in self.participants.values() if p.receiver_id is not None]
+        return sum(1 for p in matched if p.match_message_id is not None), len(matched)
+
+    def undelivered(self) -> List[int]:
+        """Ids of the participants whose match couldn't be sent"""
+
+        return [user_id for user_id, p in self.participants.items() if p.match_message_id == NOT_DELIVERED]
 
     def get_user_join_message_id(self, user: Union[int, User]) -> int:
         user_id = self.user_id(user)
-        # noinspection PyTypeChecker
-        return self._santa_dict["participants"][user_id]["last_join_message_id"]
+        return self.participants[user_id].last_join_message_id
 
     def set_user_join_message_id(self, user: Union[int, User], message_id: int):
         user_id = self.user_id(user)
-        self._santa_dict["participants"][user_id]["last_join_message_id"] = message_id
+        self.participants[user_id].last_join_message_id = message_id
+        self.dirty = True
 
     def get_user_name(self, user: Union[int, User]) -> str:
         user_id = self.user_id(user)
-        # noinspection PyTypeChecker
-        return self._santa_dict["participants"][user_id]["name"]
+        return self.participants[user_id].name
 
     def set_user_name(self, user: Union[int, User], name: str):
         user_id = self.user_id(user)
-        self._santa_dict["participants"][user_id]["name"] = name
+        self._rename(user_id, name)
 
     def user_mention_escaped(self, user: Union[int, User]) -> str:
         user_id = self.user_id(user)
-        # noinspection PyTypeChecker
-        name = self._santa_dict["participants"][user_id]["name"]
-
-        return utilities.mention_escaped_by_id(user_id, name)
+        return self._mention(user_id, self.participants[user_id])
 
     def link(self):
         link = ""
@@ -0,0 +1,558 @@
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from abc import abstractmethod
+from collections import defaultdict
+from typing import Optional, Tuple, Dict, List, BinaryIO
+
+# noinspection PyPackageRequirements
+from telegram.ext import BasePersistence, PicklePersistence
+
+logger = logging.getLogger(__name__)
+
+TABLES = ("chat_data", "user_data", "bot_data", "conversations")
+
+
+def digest(blob: bytes) -> bytes:
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+def is_dirty(value: object) -> bool:
+    """Whether a chat_data/user_data/bot_data row contains objects that track their changes (eg. SecretSanta),
+    at any depth, that changed since they were last persisted"""
+
+    if isinstance(value, dict):
+        return any(is_dirty(v) for v in list(value.values()))
+
+    return getattr(value, "dirty", False)
+
+
+def mark_clean(value: object):
+    if isinstance(value, dict):
+        for v in list(value.values()):
+            mark_clean(v)
+    elif getattr(value, "dirty", False):
+        value.dirty = False
+
+
+def dumps(value: object, attempts: int = 3) -> bytes:
+    """Pickle a value that other threads might be modifying (eg. bot_data): if a dict changes size while it's
+    being pickled, try again"""
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except RuntimeError:
+            if attempt == attempts:
+                raise
+
+
+class SafePicklePersistence(PicklePersistence):
+    """PicklePersistence that starts from scratch if the file is corrupted (it's set aside as *.corrupt), instead of
+    raising. This way the file doesn't need to be unpickled once more beforehand just to validate it. The file is also written atomically,
+    so a crash while dumping it doesn't leave a truncated pickle behind. Updates and dumps are serialized, as they
+    can come from several threads.
+    Objects with __slots__ and no __dict__ (eg. SecretSanta) are not copied by BasePersistence, so a change to them
+    can't be detected by comparing the old and the new chat_data: their dirty flag is checked too"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        with self._lock:
+            if self.chat_data is not None and is_dirty(data):
+                self.chat_data.pop(chat_id, None)  # so PicklePersistence doesn't find it unchanged
+
+            super().update_chat_data(chat_id, data)
+            mark_clean(data)
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        with self._lock:
+            if self.user_data is not None and is_dirty(data):
+                self.user_data.pop(user_id, None)
+
+            super().update_user_data(user_id, data)
+            mark_clean(data)
+
+    def update_bot_data(self, data: dict) -> None:
+        with self._lock:
+            if self.bot_data is not None and is_dirty(data):
+                self.bot_data = None  # eg. the matches of a started santa in bot_data are being sent
+
+            super().update_bot_data(data)
+            mark_clean(data)
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        with self._lock:
+            super().update_conversation(name, key, new_state)
+
+    def flush(self) -> None:
+        with self._lock:
+            super().flush()
+
+    def _load_singlefile(self) -> None:
+        try:
+            super()._load_singlefile()
+        except TypeError as e:
+            # PicklePersistence wraps any unpickling error into a TypeError: only a corrupted or truncated file is
+            # set aside, anything else (eg. a renamed module or class) must not cost us the data
+            if not isinstance(e.__cause__, (pickle.UnpicklingError, EOFError)):
+                raise
+
+            corrupt_file_path = f"{self.filename}.corrupt"
+            logger.warning("deserialization failed (%s): moving the persistence file to %s and starting from scratch",
+                           e.__cause__, corrupt_file_path)
+            os.replace(self.filename, corrupt_file_path)
+            super()._load_singlefile()
+
+    def _dump_singlefile(self) -> None:
+        tmp_file_path = f"{self.filename}.tmp"
+        with open(tmp_file_path, "wb") as f:
+            data = {
+                'conversations': self.conversations,
+                'user_data': self.user_data,
+                'chat_data': self.chat_data,
+                'bot_data': self.bot_data,
+                'callback_data': self.callback_data,
+            }
+            pickle.dump(data, f)
+
+        os.replace(tmp_file_path, self.filename)
+
+
+class RowPersistence(BasePersistence):
+    """Base class for persistences that store one row per chat_data/user_data chat/user id and per bot_data key.
+    The digest of the last written value of each row is kept in memory: only rows whose serialized value changed
+    are passed to _commit(), once per update_* call. Subclasses implement _load_rows() and _commit()"""
+
+    def __init__(
+            self,
+            store_user_data: bool = True,
+            store_chat_data: bool = True,
+            store_bot_data: bool = True,
+    ):
+        super().__init__(
+            store_user_data=store_user_data,
+            store_chat_data=store_chat_data,
+            store_bot_data=store_bot_data,
+        )
+
+        self.user_data: Optional[defaultdict] = None
+        self.chat_data: Optional[defaultdict] = None
+        self.bot_data: Optional[dict] = None
+        self.conversations: Optional[Dict[str, dict]] = None
+
+        self._digests: Dict[str, Dict[object, bytes]] = {table: {} for table in TABLES}  # last written values
+        self._lock = threading.RLock()
+
+    # our data never contains Bot instances: skip BasePersistence's recursive copy of everything we get/save
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    @abstractmethod
+    def _load_rows(self, table: str) -> Dict[object, bytes]:
+        pass
+
+    @abstractmethod
+    def _commit(self, table: str, upserts: List[Tuple[object, bytes]], deletes: List[object]):
+        pass
+
+    def _load_table(self, table: str) -> dict:
+        data = {}
+        with self._lock:
+            for key, blob in self._load_rows(table).items():
+                data[key] = pickle.loads(blob)
+                self._digests[table][key] = digest(blob)
+
+        logger.debug("loaded %d rows from %s", len(data), table)
+        return data
+
+    def _write_rows(self, table: str, rows: dict, delete_missing: bool = False):
+        """Serialize the passed rows and commit the ones that changed since the last write. Rows with an empty dict
+        as value are deleted. If delete_missing is true, rows of the table that are not in the passed dict are
+        deleted too"""
+
+        digests = self._digests[table]
+        upserts = []
+        deletes = []
+        with self._lock:
+            for key, value in rows.items():
+                if isinstance(value, dict) and not value:
+                    if key in digests:
+                        deletes.append(key)
+                    continue
+
+                blob = dumps(value)
+                mark_clean(value)
+                blob_digest = digest(blob)
+                if digests.get(key) == blob_digest:
+                    continue
+
+                upserts.append((key, blob, blob_digest))
+
+            if delete_missing:
+                deletes.extend(key for key in digests if key not in rows)
+
+            if not upserts and not deletes:
+                return
+
+            self._commit(table, [(key, blob) for key, blob, _ in upserts], deletes)
+
+            for key, _, blob_digest in upserts:
+                digests[key] = blob_digest
+            for key in deletes:
+                digests.pop(key, None)
+
+        logger.debug("%s: %d rows written, %d rows deleted", table, len(upserts), len(deletes))
+
+    def get_user_data(self) -> defaultdict:
+        if self.user_data is None:
+            self.user_data = defaultdict(dict, self._load_table("user_data"))
+
+        return self.user_data
+
+    def get_chat_data(self) -> defaultdict:
+        if self.chat_data is None:
+            self.chat_data = defaultdict(dict, self._load_table("chat_data"))
+
+        return self.chat_data
+
+    def get_bot_data(self) -> dict:
+        if self.bot_data is None:
+            self.bot_data = self._load_table("bot_data")
+
+        return self.bot_data
+
+    def get_conversations(self, name: str) -> dict:
+        if self.conversations is None:
+            self.conversations = self._load_table("conversations")
+
+        return self.conversations.get(name, {}).copy()
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        conversation = self.conversations.setdefault(name, {})
+        if conversation.get(key) == new_state:
+            return
+
+        conversation[key] = new_state
+        self._write_rows("conversations", {name: conversation})
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        self._write_rows("user_data", {user_id: data})
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._write_rows("chat_data", {chat_id: data})
+
+    def update_bot_data(self, data: dict) -> None:
+        self._write_rows("bot_data", data, delete_missing=True)
+
+
+class SQLitePersistence(RowPersistence):
+    """Stores the rows in a SQLite database in WAL mode, one table per kind of data. Each update_* call that
+    changed something costs a single, small transaction"""
+
+    def __init__(self, file_path: str = 'persistence/data.sqlite', **kwargs):
+        super().__init__(**kwargs)
+        self.file_path = file_path
+
+        # autocommit mode: we open our transactions explicitly
+        self._connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        for table in TABLES:
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (key PRIMARY KEY, value BLOB NOT NULL)")
+
+    def _load_rows(self, table: str) -> Dict[object, bytes]:
+        return dict(self._connection.execute(f"SELECT key, value FROM {table}"))
+
+    def _commit(self, table: str, upserts: List[Tuple[object, bytes]], deletes: List[object]):
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany(f"INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)", upserts)
+            self._connection.executemany(f"DELETE FROM {table} WHERE key = ?", [(key,) for key in deletes])
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def flush(self) -> None:
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.close()
+
+
+class Journal:
+    """Append-only file of (table, key, value) records. Each record is framed with its length and crc32, so that
+    a torn write at the end of the file (crash while appending) can be detected and discarded"""
+
+    HEADER = struct.Struct("<II")
+
+    @classmethod
+    def write_record(cls, f: BinaryIO, table: str, key: object, blob: Optional[bytes]):
+        # blob is None for deleted rows
+        payload = pickle.dumps((table, key, blob), protocol=pickle.HIGHEST_PROTOCOL)
+        f.write(cls.HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+    @classmethod
+    def replay(cls, file_path: str, rows: Dict[str, Dict[object, bytes]]) -> int:
+        """Apply the records of a journal file to the passed rows. Returns the number of records applied"""
+
+        applied = 0
+        valid_size = 0
+        with open(file_path, "rb") as f:
+            while True:
+                header = f.read(cls.HEADER.size)
+                if not header:
+                    break
+
+                if len(header) == cls.HEADER.size:
+                    length, crc = cls.HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length and zlib.crc32(payload) == crc:
+                        table, key, blob = pickle.loads(payload)
+                        if blob is None:
+                            rows[table].pop(key, None)
+                        else:
+                            rows[table][key] = blob
+
+                        applied += 1
+                        valid_size = f.tell()
+                        continue
+
+                logger.warning("torn record at offset %d of %s: discarding the journal tail", valid_size, file_path)
+                break
+
+        if valid_size != os.path.getsize(file_path):
+            os.truncate(file_path, valid_size)
+
+        return applied
+
+
+class JournalPersistence(RowPersistence):
+    """Appends a record to a journal file for every row that changed, so the cost of an update doesn't depend on
+    how much data we store. A background thread fsyncs the journal every fsync_interval seconds (that's the most
+    we can lose in case of a crash) and, every snapshot_interval seconds, compacts it into a new snapshot.
+    At startup, the latest snapshot is loaded and the journal tail is replayed on top of it"""
+
+    def __init__(
+            self,
+            directory: str = 'persistence',
+            fsync_interval: float = 1.0,
+            snapshot_interval: float = 60 * 60,
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.snapshot_file_path = os.path.join(directory, "journal.snapshot")
+        self.journal_file_path = os.path.join(directory, "journal.log")
+        self.compacting_file_path = os.path.join(directory, "journal.log.compacting")
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+
+        self._rows = self._recover()
+        self._journal = open(self.journal_file_path, "ab")
+        self._pending_fsync = False
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._background_loop, name="journal", daemon=True)
+        self._thread.start()
+
+    def _read_snapshot(self) -> Dict[str, Dict[object, bytes]]:
+        rows = {table: {} for table in TABLES}
+        try:
+            with open(self.snapshot_file_path, "rb") as f:
+                rows.update(pickle.load(f))
+        except FileNotFoundError:
+            pass
+
+        return rows
+
+    def _write_snapshot(self, rows: Dict[str, Dict[object, bytes]]):
+        tmp_file_path = f"{self.snapshot_file_path}.tmp"
+        with open(tmp_file_path, "wb") as f:
+            pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_file_path, self.snapshot_file_path)
+
+    def _recover(self) -> Dict[str, Dict[object, bytes]]:
+        rows = self._read_snapshot()
+
+        # a journal being compacted when we were stopped comes before the current one
+        for file_path in (self.compacting_file_path, self.journal_file_path):
+            if os.path.exists(file_path):
+                applied = Journal.replay(file_path, rows)
+                logger.info("replayed %d journal records from %s", applied, file_path)
+
+        if os.path.exists(self.compacting_file_path):
+            self._write_snapshot(rows)
+            os.remove(self.compacting_file_path)
+
+        return rows
+
+    def _load_rows(self, table: str) -> Dict[object, bytes]:
+        # the recovered rows are only needed until everything has been loaded
+        return self._rows.pop(table, {})
+
+    def _commit(self, table: str, upserts: List[Tuple[object, bytes]], deletes: List[object]):
+        for key, blob in upserts:
+            Journal.write_record(self._journal, table, key, blob)
+        for key in deletes:
+            Journal.write_record(self._journal, table, key, None)
+
+        # hand the records to the OS right away: if the process dies they're not lost, only an OS crash
+        # can lose what has been written since the last fsync
+        self._journal.flush()
+        self._pending_fsync = True
+
+    def _fsync(self):
+        with self._lock:
+            if not self._pending_fsync:
+                return
+
+            os.fsync(self._journal.fileno())
+            self._pending_fsync = False
+
+    def _merge_compacting(self) -> int:
+        """Merge the rotated journal into a new snapshot and remove it. Returns the number of records merged"""
+
+        rows = self._read_snapshot()
+        applied = Journal.replay(self.compacting_file_path, rows)
+        self._write_snapshot(rows)
+        os.remove(self.compacting_file_path)
+
+        return applied
+
+    def compact(self):
+        """Rotate the journal, then merge the rotated journal into a new snapshot. Only the rotation holds the
+        lock: the merge doesn't touch the live data"""
+
+        if os.path.exists(self.compacting_file_path):
+            # left over by a compaction that failed: its records come before the ones of the journal we're about to
+            # rotate, which would otherwise replace it
+            applied = self._merge_compacting()
+            logger.warning("merged %d records left over by a failed compaction into the snapshot", applied)
+
+        with self._lock:
+            if self._journal.tell() == 0:
+                return
+
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+            os.replace(self.journal_file_path, self.compacting_file_path)
+            self._journal = open(self.journal_file_path, "ab")
+            self._pending_fsync = False
+
+        start = time.perf_counter()
+        applied = self._merge_compacting()
+
+        logger.info("journal compacted: %d records merged into the snapshot in %.3fs", applied, time.perf_counter() - start)
+
+    def _background_loop(self):
+        last_snapshot = time.monotonic()
+        while not self._stop_event.wait(self.fsync_interval):
+            try:
+                self._fsync()
+                if time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    self.compact()
+                    last_snapshot = time.monotonic()
+            except Exception as e:
+                logger.error("error in the journal background thread: %s", str(e), exc_info=True)
+
+    def flush(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+
+        self.compact()
+        with self._lock:
+            self._journal.close()
+
+
+def import_pickle(pickle_file_path: str, persistence: RowPersistence):
+    """One-shot import of a PicklePersistence single file into an empty RowPersistence"""
+
+    logger.info("importing %s into %s...", pickle_file_path, type(persistence).__name__)
+    try:
+        with open(pickle_file_path, "rb") as f:
+            data = pickle.load(f)
+
+        persistence._write_rows("chat_data", data.get("chat_data", {}))
+        persistence._write_rows("user_data", data.get("user_data", {}))
+        persistence._write_rows("bot_data", data.get("bot_data", {}))
+        persistence._write_rows("conversations", data.get("conversations", {}))
+    finally:
+        # closes the database/stops the journal's thread even if the import failed
+        persistence.flush()
+
+    logger.info(
+        "...import completed: %d chats, %d users, %d bot_data keys",
+        len(data.get("chat_data", {})),
+        len(data.get("user_data", {})),
+        len(data.get("bot_data", {}))
+    )
+
+
+def remove_files(*file_paths: str):
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def import_pickle_to_sqlite(pickle_file_path: str, sqlite_file_path: str):
+    """Import into a temporary database, moved into place only once the import succeeded: a failed import must not
+    leave behind a database that looks like a completed one"""
+
+    tmp_file_path = f"{sqlite_file_path}.importing"
+    tmp_file_paths = (tmp_file_path, f"{tmp_file_path}-wal", f"{tmp_file_path}-shm")
+    remove_files(*tmp_file_paths)  # left over by an import that was interrupted
+    try:
+        import_pickle(pickle_file_path, SQLitePersistence(tmp_file_path))
+        os.replace(tmp_file_path, sqlite_file_path)
+    finally:
+        remove_files(*tmp_file_paths)
+
+
+def import_pickle_to_journal(pickle_file_path: str, directory: str, **kwargs):
+    """Import into a temporary directory, the snapshot is moved into `directory` only once the import succeeded"""
+
+    tmp_directory = os.path.join(directory, "journal.importing")
+    shutil.rmtree(tmp_directory, ignore_errors=True)  # left over by an import that was interrupted
+    os.makedirs(tmp_directory)
+    try:
+        import_pickle(pickle_file_path, JournalPersistence(tmp_directory, **kwargs))
+
+        tmp_snapshot_file_path = os.path.join(tmp_directory, "journal.snapshot")
+        if os.path.exists(tmp_snapshot_file_path):  # not written if there was nothing to import
+            os.replace(tmp_snapshot_file_path, os.path.join(directory, "journal.snapshot"))
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(name)s][%(levelname)s] >>> %(message)s', level=logging.INFO)
+
+    if len(sys.argv) != 3:
+        print(f"usage: {sys.argv[0]} PICKLE_FILE SQLITE_FILE")
+        sys.exit(1)
+
+    if os.path.exists(sys.argv[2]):
+        print(f"{sys.argv[2]} already exists")
+        sys.exit(1)
+
+    import_pickle_to_sqlite(sys.argv[1], sys.argv[2])
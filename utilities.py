@@ -1,22 +1,29 @@
 import datetime
 import logging
 import os
-import pickle
-import random
 import re
+import time
+from contextlib import contextmanager
 from html import escape
 from typing import Union, List
 
 # noinspection PyPackageRequirements
 from telegram import Message, User, Bot, Chat
-# noinspection PyPackageRequirements
-from telegram.error import BadRequest, TelegramError
-from telegram.ext import PicklePersistence
 
 from config import config
+from reporter import ErrorReporter
+from storage import SafePicklePersistence, SQLitePersistence, JournalPersistence, import_pickle_to_sqlite, \
+    import_pickle_to_journal
 
 logger = logging.getLogger(__name__)
 
+# errors and warnings for the log chat are sent by a background thread, deduplicated, as periodic digests
+error_reporter = ErrorReporter(
+    config.telegram.log_chat,
+    interval=config.telegram.get('error_report_interval', 10),
+    max_keys=config.telegram.get('error_report_max_keys', 100)
+)
+
 
 def now_utc():
     return datetime.datetime.utcnow()
@@ -88,72 +95,52 @@ def safe_delete_by_id(bot: Bot, chat_id: int, message_id: int, log_error=True):
 
 
 def log_tg(bot: Bot, text: str):
-    if not config.telegram.log_chat:
-        logger.debug("can't log to Telegram: no log chat configured")
-        return
+    # returns immediately: the text is sent with the next digest (once, if logged more times meanwhile)
+    error_reporter.report(bot, ("log_tg", text), f"warning: {text}")
 
-    text = f"#{bot.username} warning: {text}"
 
+@contextmanager
+def timer(timings: dict, name: str):
+    start = time.perf_counter()
     try:
-        bot.send_message(config.telegram.log_chat, text)
-    except (BadRequest, TelegramError) as e:
-        logger.warning("exception while logging message to chat %d: %s", config.telegram.log_chat, str(e))
-        logger.debug("trying again with parse_mode disabled...")
-        bot.send_message(config.telegram.log_chat, text, parse_mode=None)
-
-
-class TooManyInvalidPicks(Exception):
-    pass
-
-
-class StuckOnLastItem(Exception):
-    pass
-
-
-def draft(items_list: list, max_invalid_picks: int = 300):
-    # logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.DEBUG)
-    logger = logging.getLogger("draft")
-
-    random.shuffle(items_list)
-
-    items_count = len(items_list)
-    result_pairs = []  # [(santa, receiver), (santa, receiver)...]
-    for i, name in enumerate(items_list):
-        santa = i
-        receiver = i + 1
-        if receiver == items_count:
-            # the last santa gifts the first in the list
-            receiver = 0
-
-        result_pairs.append((items_list[santa], items_list[receiver]))
-
-    logger.debug("%s", items_list)
-    logger.debug("%s", result_pairs)
-
-    return result_pairs
-
-
-def persistence_object(file_path='persistence/data.pickle'):
-    logger.info('unpickling persistence: %s', file_path)
-    try:
-        # try to load the file
-        try:
-            with open(file_path, "rb") as f:
-                pickle.load(f)
-        except FileNotFoundError:
-            pass
-    except (pickle.UnpicklingError, EOFError):
-        logger.warning('deserialization failed: removing persistence file and trying again')
-        os.remove(file_path)
-
-    return PicklePersistence(
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def persistence_object(file_path=None):
+    persistence_config = config.get('persistence', {})
+    file_path = file_path or persistence_config.get('pickle_file', 'persistence/data.pickle')
+    backend = persistence_config.get('backend', 'pickle')
+    if backend == 'none':
+        logger.info('persistence disabled')
+        return None
+    elif backend == 'sqlite':
+        sqlite_file_path = persistence_config.get('sqlite_file', 'persistence/data.sqlite')
+        if not os.path.exists(sqlite_file_path) and os.path.exists(file_path):
+            logger.info('no sqlite database yet: importing the pickle persistence file')
+            import_pickle_to_sqlite(file_path, sqlite_file_path)
+
+        logger.info('opening sqlite persistence: %s', sqlite_file_path)
+        return SQLitePersistence(sqlite_file_path)
+    elif backend == 'journal':
+        directory = os.path.dirname(file_path)
+        journal_kwargs = dict(
+            fsync_interval=persistence_config.get('journal_fsync_interval', 1.0),
+            snapshot_interval=persistence_config.get('journal_snapshot_interval', 60 * 60),
+        )
+        if not os.path.exists(os.path.join(directory, 'journal.snapshot')) and os.path.exists(file_path):
+            logger.info('no journal snapshot yet: importing the pickle persistence file')
+            import_pickle_to_journal(file_path, directory, **journal_kwargs)
+
+        logger.info('opening journal persistence: %s', directory)
+        return JournalPersistence(directory, **journal_kwargs)
+
+    # the file is unpickled only once, by the persistence object itself, when the dispatcher asks for the data
+    logger.info('pickle persistence: %s', file_path)
+    return SafePicklePersistence(
         filename=file_path,
         store_chat_data=True,
         store_user_data=True,
         store_bot_data=True
     )
-
-
-if __name__ == "__main__":
-    draft(["a", "b", "c", "d", "e", "f"])
-